@@ -0,0 +1,316 @@
+"""Benchmark for cfn_validate_lambda template evaluation
+
+Generates synthetic templates with a mix of security groups and EC2
+instances, pairs them with rule sets that include the seeded rules, and
+measures evaluate_template. Templates and rules come from a fixed seed, so
+runs on different commits evaluate identical inputs:
+
+    python cfn_validate_bench.py --output before.json
+    python cfn_validate_bench.py --baseline before.json
+
+Each result reports throughput in resources per second, p50 and p99
+latency per template and peak memory. With --baseline the run exits with
+status 1 if any case is slower than the baseline by more than --tolerance.
+
+With --server each case is also run through cfn_validate_server and
+compared with a cold per-invocation run, which starts a new interpreter,
+imports the function and builds the rules for every template like a cold
+Lambda container does.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+import cfn_validate_lambda
+import cfn_validate_server
+
+TEMPLATE_SIZES = [10, 100, 1000, 10000]
+RULE_COUNTS = [4, 50, 200, 1000]
+SEED = 1234
+
+# One cold invocation: a new interpreter that imports the function, builds the rules and evaluates one template
+LAMBDA_INVOCATION = """
+import os, sys, json
+sys.stdout = open(os.devnull, 'w')
+import cfn_validate_lambda
+with open(sys.argv[1]) as rulesFile:
+    rules = cfn_validate_lambda.rules_from_items(json.load(rulesFile))
+with open(sys.argv[2], 'rb') as templateFile:
+    cfn_validate_lambda.evaluate_template(rules, templateFile.read())
+"""
+
+def rule_item(name, category, ruledata, riskvalue):
+    return {
+        'rule': {'S': name},
+        'category': {'S': category},
+        'ruletype': {'S': "regex"},
+        'ruledata': {'S': ruledata},
+        'riskvalue': {'N': riskvalue},
+        'active': {'S': "Y"}
+    }
+
+
+def generate_rules(count, rng):
+    """Builds a rule set of count rules, starting with the seeded rules
+
+    The seeded rules are all made active. The extra rules look for specific
+    ports, CIDRs and AMIs, like rules written by hand for a growing rule table.
+
+    """
+    items = [dict(rule, active={'S': "Y"}) for rule in cfn_validate_lambda.DEFAULT_RULES[:count]]
+    for n in range(len(items), count):
+        kind = n % 3
+        if kind == 0:
+            items.append(rule_item("Port" + str(n), "SecurityGroup",
+                                   r"^.*Ingress.*[fF]rom[pP]ort.\s*:\s*u?.(" + str(rng.randint(1, 65535)) + r")\b", "5"))
+        elif kind == 1:
+            items.append(rule_item("Cidr" + str(n), "SecurityGroup",
+                                   r"^.*[cC]idr[iI]p.\s*:\s*u?.(" + "10\\." + str(rng.randint(0, 255)) + r"\.)", "5"))
+        else:
+            items.append(rule_item("Ami" + str(n), "EC2Instance",
+                                   r"^.*ImageId.\s*:\s*u?.(ami-" + "%08x" % rng.getrandbits(32) + ")", "10"))
+    return cfn_validate_lambda.rules_from_items(items)
+
+
+def generate_template(size, rng):
+    """Builds a template of size resources, two thirds security groups and one third EC2 instances"""
+    resources = {}
+    for n in range(size):
+        if n % 3 == 2:
+            resources["Instance" + str(n)] = {
+                "Type": "AWS::EC2::Instance",
+                "Properties": {
+                    "ImageId": rng.choice(["ami-7a11e211", "ami-0c55b159", "ami-%08x" % rng.getrandbits(32)]),
+                    "InstanceType": rng.choice(["t2.micro", "m5.large"]),
+                    "SecurityGroupIds": [{"Ref": "SecurityGroup" + str(n - 2)}],
+                    "Tags": [{"Key": "Name", "Value": "instance-" + str(n)}]
+                }
+            }
+        else:
+            ingress = []
+            for _ in range(rng.randint(1, 4)):
+                port = rng.choice([22, 80, 443, 3306, 8080])
+                ingress.append({
+                    "IpProtocol": "tcp",
+                    "FromPort": port,
+                    "ToPort": port,
+                    "CidrIp": rng.choice(["0.0.0.0/0", "10.%d.0.0/16" % rng.randint(0, 255), "72.21.196.67/32"])
+                })
+            resources["SecurityGroup" + str(n)] = {
+                "Type": "AWS::EC2::SecurityGroup",
+                "Properties": {
+                    "GroupDescription": "Security group " + str(n),
+                    "SecurityGroupIngress": ingress,
+                    "VpcId": {"Ref": "VPCName"}
+                }
+            }
+    return json.dumps({"AWSTemplateFormatVersion": "2010-09-09", "Resources": resources}).encode('utf-8')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def peak_memory_start():
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+
+def peak_memory_stop():
+    """Returns the peak memory in bytes since peak_memory_start()
+
+    Python 2 has no tracemalloc, so there the peak resident size of the
+    whole process is reported instead.
+
+    """
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_case(size, ruleCount, repeats):
+    """Benchmarks evaluate_template for one template size and rule count"""
+    rng = random.Random(SEED + size * 7919 + ruleCount)
+    rules = generate_rules(ruleCount, rng)
+    templates = [generate_template(size, rng) for _ in range(repeats)]
+
+    start = time.time()
+    ruleSet = cfn_validate_lambda.RuleSet(rules, rules['version'])
+    compileSeconds = time.time() - start
+
+    latencies = []
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        for template in templates:
+            start = time.time()
+            cfn_validate_lambda.evaluate_template(ruleSet, template)
+            latencies.append(time.time() - start)
+        # Memory tracing slows evaluation down, so peak memory is measured on a separate run
+        peak_memory_start()
+        cfn_validate_lambda.evaluate_template(ruleSet, templates[0])
+        peak = peak_memory_stop()
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+    return {
+        'resources': size,
+        'rules': ruleCount,
+        'repeats': repeats,
+        'compileSeconds': round(compileSeconds, 6),
+        'resourcesPerSecond': round(size * len(latencies) / sum(latencies), 1),
+        'p50Seconds': round(percentile(latencies, 0.5), 6),
+        'p99Seconds': round(percentile(latencies, 0.99), 6),
+        'peakMemoryBytes': peak
+    }
+
+
+def run_server_case(size, ruleCount, repeats):
+    """Compares cold per-invocation evaluation with requests to a warm validation server"""
+    rng = random.Random(SEED + size * 7919 + ruleCount)
+    rules = generate_rules(ruleCount, rng)
+    templates = [generate_template(size, rng) for _ in range(repeats)]
+    directory = tempfile.mkdtemp()
+    rulesPath = os.path.join(directory, 'rules.json')
+    templatePath = os.path.join(directory, 'template.json')
+    with open(rulesPath, 'w') as rulesFile:
+        json.dump(rules['sgRules'] + rules['ec2Rules'] + rules['otherRules'], rulesFile)
+
+    lambdaLatencies = []
+    serverLatencies = []
+    devnull = open(os.devnull, 'w')
+    # Evaluation and request logging would dominate the output
+    stdout, sys.stdout = sys.stdout, devnull
+    stderr, sys.stderr = sys.stderr, devnull
+    # One worker without a verdict cache, so every request evaluates the template
+    server = cfn_validate_server.ValidationServer(
+        ('127.0.0.1', 0), {'bench': {'rules': rulesPath}}, workers=1,
+        maxBodySize=max(len(template) for template in templates), cache=False)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        for template in templates:
+            with open(templatePath, 'wb') as templateFile:
+                templateFile.write(template)
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', LAMBDA_INVOCATION, rulesPath, templatePath],
+                                  cwd=here, stdout=devnull, stderr=devnull)
+            lambdaLatencies.append(time.time() - start)
+
+        url = 'http://127.0.0.1:{0}/tenants/bench/validate'.format(server.server_address[1])
+        # The first request warms up the worker, like the start-up of the server
+        urlopen(url, templates[0]).read()
+        for template in templates:
+            start = time.time()
+            urlopen(url, template).read()
+            serverLatencies.append(time.time() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+        sys.stdout = stdout
+        sys.stderr = stderr
+        devnull.close()
+        shutil.rmtree(directory)
+
+    return {
+        'resources': size,
+        'rules': ruleCount,
+        'repeats': repeats,
+        'lambdaP50Seconds': round(percentile(lambdaLatencies, 0.5), 6),
+        'serverP50Seconds': round(percentile(serverLatencies, 0.5), 6),
+        'serverP99Seconds': round(percentile(serverLatencies, 0.99), 6),
+        'speedup': round(percentile(lambdaLatencies, 0.5) / percentile(serverLatencies, 0.5), 1)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Lists the cases whose p50 latency regressed beyond the tolerance"""
+    previous = dict(((case['resources'], case['rules']), case) for case in baseline['results'])
+    regressions = []
+    for case in results:
+        before = previous.get((case['resources'], case['rules']))
+        if before is not None and case['p50Seconds'] > before['p50Seconds'] * (1 + tolerance):
+            regressions.append("{0} resources x {1} rules: p50 {2}s, was {3}s".format(
+                case['resources'], case['rules'], case['p50Seconds'], before['p50Seconds']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark cfn_validate_lambda template evaluation")
+    parser.add_argument('--sizes', type=int, nargs='+', default=TEMPLATE_SIZES, help="Resources per template")
+    parser.add_argument('--rules', type=int, nargs='+', default=RULE_COUNTS, help="Rules per rule set")
+    parser.add_argument('--repeats', type=int, default=5, help="Templates evaluated per case")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed p50 slowdown (default: 0.2)")
+    parser.add_argument('--server', action='store_true', help="Also compare cold invocations with a warm server")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        for ruleCount in args.rules:
+            case = run_case(size, ruleCount, args.repeats)
+            print(json.dumps(case, sort_keys=True))
+            sys.stdout.flush()
+            results.append(case)
+
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'seed': SEED, 'results': results}
+    if args.server:
+        report['server'] = []
+        for size in args.sizes:
+            for ruleCount in args.rules:
+                case = run_server_case(size, ruleCount, args.repeats)
+                print(json.dumps(dict(case, mode='server'), sort_keys=True))
+                sys.stdout.flush()
+                report['server'].append(case)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(report, outputFile, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compare(results, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
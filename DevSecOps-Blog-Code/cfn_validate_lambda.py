@@ -1,21 +1,95 @@
 from __future__ import print_function
 from boto3.session import Session
 
+import os
+import sys
+import io
 import json
+import codecs
 import urllib
 import boto3
 import zipfile
-import tempfile
+import shutil
 import botocore
 import traceback
 import re
-import zipfile
 import time
+import signal
+import socket
+import fnmatch
+import threading
+import hashlib
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Clients by service, created on first use and reused by warm containers.
+# Importing the module has no side effects, so its helpers can be shared
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Artifacts up to this size are fetched with a single GET, larger ones with range requests
+ARTIFACT_RANGE_THRESHOLD = 8 * 1024 * 1024
+# Smallest byte range fetched by one range request
+ARTIFACT_RANGE_BLOCK = 256 * 1024
+
+# DynamoDB table caching verdicts. When unset, verdicts are cached in memory by warm containers
+VERDICT_CACHE_TABLE = os.environ.get('VERDICT_CACHE_TABLE', '')
+# Days a cached verdict is kept, when time to live is enabled on the 'expires' attribute
+VERDICT_CACHE_DAYS = int(os.environ.get('VERDICT_CACHE_DAYS', '30'))
+_verdict_cache = None
+
+# Verdicts looked up in the verdict cache with one request
+VERDICT_BATCH_SIZE = 100
+# Templates larger than this are parsed and evaluated one resource at a time
+STREAMING_THRESHOLD = int(os.environ.get('STREAMING_THRESHOLD', str(4 * 1024 * 1024)))
+# Bytes read from a streamed template at a time
+STREAMING_CHUNK = 64 * 1024
+
+# Seconds a regex rule may spend matching one resource before it is aborted and flagged
+RULE_TIME_BUDGET = float(os.environ.get('RULE_TIME_BUDGET', '1.0'))
+# Number of rules listed in the per-evaluation rule profile
+RULE_PROFILE_SIZE = 5
+
+# Templates with at least this risk fail the pipeline, templates with at least
+# FLAGGED_THRESHOLD need a manual approval
+FAILURE_THRESHOLD = 50
+FLAGGED_THRESHOLD = 5
+
+# Shortest literal worth using to prefilter a regex rule
+PREFILTER_MIN_LITERAL = 3
+
+# Rules table name. When unset the table is found by name with list_tables
+RULES_TABLE = os.environ.get('RULES_TABLE', '')
+# Seconds a warm container trusts its loaded rules before checking the rule-set version
+RULES_CACHE_TTL = int(os.environ.get('RULES_CACHE_TTL', '300'))
+# Key of the rules table item whose 'version' attribute identifies the rule set
+RULE_SET_VERSION_KEY = "__version__"
+_rules_cache = {'table': None, 'rules': None, 'loaded': 0}
+# S3 client for the output bucket, created on first use and reused by warm containers
+_output_s3 = None
+
+# Compiled rule sets are kept across warm invocations, keyed by rule-set version
+RULE_SET_CACHE_SIZE = 8
+_rule_set_cache = {}
+
+def get_client(service):
+    """Gets the client of a service, creating it on first use
+
+    Args:
+        service: The service name, for example 'dynamodb'
 
-print('Loading function')
+    Returns:
+        The boto3 client
+
+    """
+    with _clients_lock:
+        if service not in _clients:
+            _clients[service] = boto3.client(service)
+        return _clients[service]
 
-cf = boto3.client('cloudformation')
-code_pipeline = boto3.client('codepipeline')
 
 def find_artifact(artifacts, name):
     """Finds the artifact 'name' among the 'artifacts'
@@ -36,34 +110,178 @@ def find_artifact(artifacts, name):
     raise Exception('Input artifact named "{0}" not found in event'.format(name))
 
 
-def get_template(s3, artifact, file_in_zip):
-    """Gets the template artifact
+class S3RangeReader(object):
+    """A read-only, seekable file over an S3 object that fetches byte ranges on demand
 
-    Downloads the artifact from the S3 artifact store to a temporary file
-    then extracts the zip and returns the file containing the CloudFormation
-    template.
+    zipfile only reads the end of central directory record, the central
+    directory and the members it is asked for, so wrapping an artifact in
+    this reader downloads just those parts of the zip.
 
     Args:
-        artifact: The artifact to download
-        file_in_zip: The path to the file within the zip containing the template
+        s3: The S3 client
+        bucket: The bucket holding the object
+        key: The object key
+        size: The object size in bytes
+
+    """
+    def __init__(self, s3, bucket, key, size):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.position = 0
+        self.bufferStart = 0
+        self.buffer = b''
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset = self.position + offset
+        elif whence == 2:
+            offset = self.size + offset
+        self.position = max(0, offset)
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        if self.position >= end:
+            return b''
+        bufferEnd = self.bufferStart + len(self.buffer)
+        if not self.bufferStart <= self.position or end > bufferEnd:
+            # Fetch at least a whole block, extending backwards near the end of
+            # the object so the zip directory is read together with its end record
+            fetchEnd = max(end, min(self.size, self.position + ARTIFACT_RANGE_BLOCK))
+            self._fetch(min(self.position, max(0, fetchEnd - ARTIFACT_RANGE_BLOCK)), fetchEnd)
+        data = self.buffer[self.position - self.bufferStart:end - self.bufferStart]
+        self.position = end
+        return data
+
+    def _fetch(self, start, end):
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range='bytes={0}-{1}'.format(start, end - 1))
+        self.buffer = response['Body'].read()
+        self.bufferStart = start
+
+    def close(self):
+        self.buffer = b''
+
+
+def open_artifact(s3, artifact):
+    """Opens the zipped artifact in the S3 artifact store without writing it to disk
+
+    Small artifacts are read into memory with a single request. Larger ones
+    are read through an S3RangeReader so only the zip directory and the
+    members actually read are downloaded.
+
+    Args:
+        s3: The S3 client
+        artifact: The artifact to open
 
     Returns:
-        The CloudFormation template as a string
+        A zipfile.ZipFile over the artifact
 
     Raises:
-        Exception: Any exception thrown while downloading the artifact or unzipping it
+        Exception: Any exception thrown while reading the artifact or its zip directory
 
     """
-    tmp_file = tempfile.NamedTemporaryFile()
     bucket = artifact['location']['s3Location']['bucketName']
     key = artifact['location']['s3Location']['objectKey']
 
-    with tempfile.NamedTemporaryFile() as tmp_file:
-        print("Retrieving s3://" + bucket + "/" + key)
-        s3.download_file(bucket, key, tmp_file.name)
-        with zipfile.ZipFile(tmp_file.name, 'r') as zip:
-            zip.printdir()
-            return zip.read(file_in_zip)
+    print("Retrieving s3://" + bucket + "/" + key)
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if size <= ARTIFACT_RANGE_THRESHOLD:
+        fileobj = io.BytesIO(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    else:
+        fileobj = S3RangeReader(s3, bucket, key, size)
+    return zipfile.ZipFile(fileobj, 'r')
+
+
+def get_templates(s3, artifact, files):
+    """Gets several template files out of the artifact
+
+    The artifact is opened once and every matching template is read from it.
+
+    Args:
+        artifact: The artifact to read
+        files: The path of a template within the zip, a glob such as
+            "templates/*.json", or a list of paths and globs
+
+    Returns:
+        A list of (path, template) tuples in the order of the zip directory
+
+    Raises:
+        Exception: If a path or glob matches no file in the artifact
+
+    """
+    patterns = files if isinstance(files, list) else [files]
+    with open_artifact(s3, artifact) as zip:
+        names = zip.namelist()
+        selected = []
+        for pattern in patterns:
+            matches = [name for name in names if name == pattern or fnmatch.fnmatchcase(name, pattern)]
+            if not matches:
+                raise Exception('No file matching "{0}" found in artifact'.format(pattern))
+            selected.extend(name for name in matches if name not in selected)
+        return [(name, zip.read(name)) for name in names if name in selected]
+
+
+def map_concurrently(function, items, workers, deadline=None):
+    """Applies function to every item on a bounded pool of threads
+
+    Plain threads are used because multiprocessing pools need /dev/shm,
+    which Lambda does not provide. With a single item or worker, items are
+    processed on the calling thread instead.
+
+    Args:
+        function: The function to apply
+        items: The list of items
+        workers: The maximum number of threads
+        deadline: An optional time.time() value to stop at. Items not
+            started before the deadline are skipped, and items still being
+            processed at the deadline are abandoned; both are left as None.
+
+    Returns:
+        The list of results, in the order of items
+
+    Raises:
+        Exception: The first exception raised by function
+
+    """
+    results = [None] * len(items)
+    if workers <= 1 or len(items) <= 1:
+        for index, item in enumerate(items):
+            if deadline is not None and time.time() >= deadline:
+                break
+            results[index] = function(item)
+        return results
+    errors = []
+    pending = list(reversed(range(len(items))))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors or (deadline is not None and time.time() >= deadline):
+                    return
+                index = pending.pop()
+            try:
+                results[index] = function(items[index])
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(None if deadline is None else max(0, deadline - time.time()))
+    if errors:
+        raise errors[0]
+    return list(results)
 
 
 def put_job_success(job, message):
@@ -79,7 +297,7 @@ def put_job_success(job, message):
     """
     print('Putting job success')
     print(message)
-    code_pipeline.put_job_success_result(jobId=job)
+    get_client('codepipeline').put_job_success_result(jobId=job)
 
 def put_job_failure(job, message):
     """Notify CodePipeline of a failed job
@@ -94,7 +312,7 @@ def put_job_failure(job, message):
     """
     print('Putting job failure')
     print(message)
-    code_pipeline.put_job_failure_result(jobId=job, failureDetails={'message': message, 'type': 'JobFailed'})
+    get_client('codepipeline').put_job_failure_result(jobId=job, failureDetails={'message': message, 'type': 'JobFailed'})
 
 def continue_job_later(job, message):
     """Notify CodePipeline of a continuing job
@@ -118,7 +336,7 @@ def continue_job_later(job, message):
 
     print('Putting job continuation')
     print(message)
-    code_pipeline.put_job_success_result(jobId=job, continuationToken=continuation_token)
+    get_client('codepipeline').put_job_success_result(jobId=job, continuationToken=continuation_token)
 
 def get_user_params(job_data):
     print(job_data)
@@ -155,6 +373,15 @@ def get_user_params(job_data):
         # with a helpful message.
         raise Exception('Your UserParameters JSON must include the template file name')
 
+    if not isinstance(decoded_parameters['file'], (list, str, type(u''))):
+        # The template file can be a name, a glob or a list of them
+        raise Exception('The template file in your UserParameters JSON must be a string or a list')
+
+    if isinstance(decoded_parameters['file'], list) and \
+            (not decoded_parameters['file'] or not all(isinstance(f, (str, type(u''))) for f in decoded_parameters['file'])):
+        # A list must name at least one file to validate
+        raise Exception('The template file list in your UserParameters JSON must be a non-empty list of file names')
+
     if 'output' not in decoded_parameters:
         # Validate that the template file is provided, otherwise fail the job
         # with a helpful message.
@@ -185,175 +412,1591 @@ def setup_s3_client(job_data):
         aws_session_token=session_token)
     return session.client('s3', config=botocore.client.Config(signature_version='s3v4'))
 
-def get_rules():
-    # Find table
-    client = boto3.client('dynamodb')
-    resource = boto3.resource('dynamodb')
-    response = client.list_tables()
-    logTable = ""
-    for i in range(len(response['TableNames'])):
-        if "lab3DDBRules" in response['TableNames'][i]:
-            logTable = response['TableNames'][i]
+def find_rules_table():
+    """Finds the rules table, using RULES_TABLE when it is configured
 
-    # Verify that rules are created and if not, create them
-    response = client.scan(
+    Returns:
+        The name of the DynamoDB table holding the rules
+
+    """
+    if RULES_TABLE:
+        return RULES_TABLE
+    if _rules_cache['table'] is None:
+        logTable = ""
+        for page in get_client('dynamodb').get_paginator('list_tables').paginate():
+            for tableName in page['TableNames']:
+                if "lab3DDBRules" in tableName:
+                    logTable = tableName
+        _rules_cache['table'] = logTable
+    return _rules_cache['table']
+
+
+def get_rule_set_version(logTable):
+    """Reads the version attribute recorded for the rule set
+
+    Args:
+        logTable: The rules table
+
+    Returns:
+        The stored rule-set version, or None if the table has no version item
+
+    """
+    item = get_client('dynamodb').get_item(
         TableName=logTable,
-        AttributesToGet=[
-            'rule',
-        ]
-    )
-    if len(response['Items']) == 0:
-        add_rules(logTable)
-        time.sleep(45)
-
-    # Get all rules from DDB.
-    # Rules have rule, ruledata, type and weight
+        Key={'rule': {'S': RULE_SET_VERSION_KEY}},
+        ConsistentRead=True
+    ).get('Item')
+    if item is None or 'version' not in item:
+        return None
+    return item['version']['S']
+
+
+def rules_from_items(items):
+    """Groups rule items, as stored in the rules table, into a rules dictionary
+
+    Args:
+        items: The DynamoDB items of the rules table
+
+    The version of the rules is a fingerprint of the rule items, so verdicts
+    cached for a version always belong to the same rule content. The version
+    stored in the table is kept as storedVersion, to check cheaply whether
+    the table changed.
+
+    Returns:
+        The rules dictionary, or None if the items hold no rules
+
+    """
+    # Rules have rule, category, ruletype, ruledata, riskvalue and active,
+    # and optionally resourcetypes and rulepath
     rules = dict()
     sgRules = []
     ec2Rules = []
+    otherRules = []
+    storedVersion = None
 
-    for n in range(len(response['Items'])):
-        rule = client.get_item(
-            TableName=logTable,
-            Key={
-                'rule': {'S':response['Items'][n]['rule']['S']}
-            },
-            ConsistentRead=True
-        )['Item']
-        if rule['category']['S'] == "SecurityGroup":
+    for rule in items:
+        if rule['rule']['S'] == RULE_SET_VERSION_KEY:
+            storedVersion = rule['version']['S']
+        elif rule['category']['S'] == "SecurityGroup":
             sgRules.append(rule)
         elif rule['category']['S'] == "EC2Instance":
             ec2Rules.append(rule)
+        else:
+            otherRules.append(rule)
+    if not sgRules and not ec2Rules and not otherRules:
+        return None
     rules['sgRules'] = sgRules
     rules['ec2Rules'] = ec2Rules
+    rules['otherRules'] = otherRules
+    rules['version'] = rule_set_version(rules)
+    rules['storedVersion'] = storedVersion
     return rules
 
 
+def load_rules(logTable):
+    """Loads every rule from the rules table with one paginated scan
+
+    Args:
+        logTable: The rules table
+
+    Returns:
+        The rules dictionary, or None if the table holds no rules
+
+    """
+    items = []
+    for page in get_client('dynamodb').get_paginator('scan').paginate(TableName=logTable, ConsistentRead=True):
+        items.extend(page['Items'])
+    return rules_from_items(items)
+
+
+def get_rules():
+    """Gets the validation rules from DynamoDB
+
+    Rules loaded by a warm container are reused for RULES_CACHE_TTL seconds.
+    After that a single read of the rule-set version stored in the table
+    decides whether the table has to be scanned again; rule sets without a
+    version item are always re-read.
+
+    Returns:
+        The rules dictionary with the sgRules, ec2Rules and version keys
+
+    """
+    now = time.time()
+    cached = _rules_cache['rules']
+    if cached is not None and now - _rules_cache['loaded'] < RULES_CACHE_TTL:
+        return cached
+
+    logTable = find_rules_table()
+    if cached is not None and cached['storedVersion'] is not None and \
+            get_rule_set_version(logTable) == cached['storedVersion']:
+        _rules_cache['loaded'] = now
+        return cached
+
+    # Verify that rules are created and if not, create them
+    rules = load_rules(logTable)
+    if rules is None:
+        rules = add_rules(logTable)
+
+    _rules_cache['rules'] = rules
+    _rules_cache['loaded'] = now
+    return rules
+
+
+# Rules seeded into an empty rules table
+DEFAULT_RULES = [
+    {
+        'rule' : {'S': "IngressOpenToWorld"},
+        'category' : {'S': "SecurityGroup"},
+        'ruletype' : {'S': "regex"},
+        'ruledata' : {'S': r"^.*Ingress.*((0\.){3}0\/0)"},
+        'riskvalue' : {'N': "100"},
+        'active' : {'S': "Y"}
+    },
+    {
+        'rule' : {'S': "SSHOpenToWorld"},
+        'category' : {'S': "SecurityGroup"},
+        'ruletype' : {'S': "regex"},
+        'ruledata' : {'S': r"^.*Ingress.*(([fF]rom[pP]ort|[tT]o[pP]ort).\s*:\s*u?.(22).*[cC]idr[iI]p.\s*:\s*u?.((0\.){3}0\/0)|[cC]idr[iI]p.\s*:\s*u?.((0\.){3}0\/0).*([fF]rom[pP]ort|[tT]o[pP]ort).\s*:\s*u?.(22))"},
+        'riskvalue' : {'N': "100"},
+        'active' : {'S': "Y"}
+    },
+    {
+        'rule' : {'S': "AllowHttp"},
+        'category' : {'S': "SecurityGroup"},
+        'ruletype' : {'S': "regex"},
+        'ruledata' : {'S': r"^.*Ingress.*[fF]rom[pP]ort.\s*:\s*u?.(80)"},
+        'riskvalue' : {'N': "3"},
+        'active' : {'S': "N"}
+    },
+    {
+        'rule' : {'S': "ForbiddenAMIs"},
+        'category' : {'S': "EC2Instance"},
+        'ruletype' : {'S': "regex"},
+        'ruledata' : {'S': r"^.*ImageId.\s*:\s*u?.(ami-7a11e211|ami-08111162|ami-f6035893)"},
+        'riskvalue' : {'N': "10"},
+        'active' : {'S': "N"}
+    },
+]
+
+
 def add_rules(logTable):
-    client = boto3.client('dynamodb')
-    client.put_item(
-        TableName=logTable,
-        Item={
-            'rule' : {'S': "IngressOpenToWorld"},
-            'category' : {'S': "SecurityGroup"},
-            'ruletype' : {'S': "regex"},
-            'ruledata' : {'S': "^.*Ingress.*((0\.){3}0\/0)"},
-            'riskvalue' : {'N': "100"},
-            'active' : {'S': "Y"}
-        }
-    )
-
-    client.put_item(
-        TableName=logTable,
-        Item={
-            'rule' : {'S': "SSHOpenToWorld"},
-            'category' : {'S': "SecurityGroup"},
-            'ruletype' : {'S': "regex"},
-            'ruledata' : {'S': "^.*Ingress.*(([fF]rom[pP]ort|[tT]o[pP]ort).\s*:\s*u?.(22).*[cC]idr[iI]p.\s*:\s*u?.((0\.){3}0\/0)|[cC]idr[iI]p.\s*:\s*u?.((0\.){3}0\/0).*([fF]rom[pP]ort|[tT]o[pP]ort).\s*:\s*u?.(22))"},
-            'riskvalue' : {'N': "100"},
-            'active' : {'S': "Y"}
-        }
-    )
-    client.put_item(
-        TableName=logTable,
-        Item={
-            'rule' : {'S': "AllowHttp"},
-            'category' : {'S': "SecurityGroup"},
-            'ruletype' : {'S': "regex"},
-            'ruledata' : {'S': "^.*Ingress.*[fF]rom[pP]ort.\s*:\s*u?.(80)"},
-            'riskvalue' : {'N': "3"},
-            'active' : {'S': "N"}
-        }
-    )
-    client.put_item(
-        TableName=logTable,
-        Item={
-            'rule' : {'S': "ForbiddenAMIs"},
-            'category' : {'S': "EC2Instance"},
-            'ruletype' : {'S': "regex"},
-            'ruledata' : {'S': "^.*ImageId.\s*:\s*u?.(ami-7a11e211|ami-08111162|ami-f6035893)"},
-            'riskvalue' : {'N': "10"},
-            'active' : {'S': "N"}
-        }
-    )
-
-
-def evaluate_template(rules, template):
+    """Seeds the rules table with DEFAULT_RULES and records their rule-set version
+
+    Args:
+        logTable: The rules table
+
+    Returns:
+        The rules dictionary of the seeded rules, so they can be used right
+        away without waiting to read them back
+
+    """
+    rules = rules_from_items(DEFAULT_RULES)
+    rules['storedVersion'] = rules['version']
+    items = DEFAULT_RULES + [{'rule': {'S': RULE_SET_VERSION_KEY}, 'version': {'S': rules['storedVersion']}}]
+    request = {logTable: [{'PutRequest': {'Item': item}} for item in items]}
+    while request:
+        request = get_client('dynamodb').batch_write_item(RequestItems=request).get('UnprocessedItems')
+    return rules
+
+
+def resolve_path(value, path):
+    """Resolves a property path such as Properties.SecurityGroupIngress[*].CidrIp
+
+    Keys are matched exactly first and case-insensitively otherwise. A [*]
+    segment expands every element of a list; a single object in place of the
+    list is treated as a list of one, as CloudFormation allows.
+
+    Args:
+        value: The parsed template node to start from
+        path: The dotted path, or an empty string for the node itself
+
+    Returns:
+        The list of values found at the path
+
+    """
+    values = [value]
+    for segment in path.split('.') if path else []:
+        index = None
+        if segment.endswith(']'):
+            segment, index = segment[:-1].split('[')
+        found = []
+        for node in values:
+            if not isinstance(node, dict):
+                continue
+            if segment in node:
+                found.append(node[segment])
+                continue
+            for key in node:
+                if key.lower() == segment.lower():
+                    found.append(node[key])
+                    break
+        if index is not None:
+            elements = []
+            for node in found:
+                if not isinstance(node, list):
+                    node = [node]
+                if index == '*':
+                    elements.extend(node)
+                elif int(index) < len(node):
+                    elements.append(node[int(index)])
+            found = elements
+        values = found
+    return values
+
+
+def parse_cidr(cidr):
+    """Parses an IPv4 or IPv6 CIDR into an address family and integer range
+
+    Args:
+        cidr: The CIDR string, e.g. 0.0.0.0/0
+
+    Returns:
+        A (family, first, last) tuple, or None if the value is not a CIDR
+
+    """
+    if not isinstance(cidr, (str, type(u''))):
+        return None
+    address, _, length = cidr.strip().partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, str(address))
+    except (socket.error, ValueError):
+        return None
+    bits = len(packed) * 8
+    length = int(length) if length.isdigit() else bits
+    if length > bits:
+        return None
+    first = 0
+    for byte in bytearray(packed):
+        first = (first << 8) | byte
+    mask = (1 << (bits - length)) - 1
+    first = first & ~mask
+    return family, first, first | mask
+
+
+def _cidr_within(inner, outer):
+    inner = parse_cidr(inner)
+    outer = parse_cidr(outer)
+    return inner is not None and outer is not None and inner[0] == outer[0] and \
+        outer[1] <= inner[1] and inner[2] <= outer[2]
+
+
+def _port_range(entry):
+    if not isinstance(entry, dict):
+        return None
+    protocol = resolve_path(entry, 'IpProtocol')
+    fromPort = resolve_path(entry, 'FromPort')
+    toPort = resolve_path(entry, 'ToPort')
+    try:
+        if not protocol or str(protocol[0]) == "-1" or not fromPort or not toPort or int(fromPort[0]) == -1:
+            return 0, 65535
+        return int(fromPort[0]), int(toPort[0])
+    except (TypeError, ValueError):
+        # Ports given as intrinsic functions can't be resolved here
+        return 0, 65535
+
+
+def _port_overlap(entry, ports):
+    portRange = _port_range(entry)
+    if not isinstance(ports, list):
+        ports = [ports, ports]
+    return portRange is not None and portRange[0] <= int(ports[1]) and int(ports[0]) <= portRange[1]
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+PREDICATE_OPERATORS = {
+    'equals': lambda actual, expected: str(actual) == str(expected),
+    'not_equals': lambda actual, expected: str(actual) != str(expected),
+    'in': lambda actual, expected: str(actual) in [str(v) for v in _as_list(expected)],
+    'regex': lambda actual, expected: re.match(expected, str(actual)) is not None,
+    'in_cidr': lambda actual, expected: any(_cidr_within(actual, cidr) for cidr in _as_list(expected)),
+    'contains_cidr': lambda actual, expected: any(_cidr_within(cidr, actual) for cidr in _as_list(expected)),
+    'port_overlap': _port_overlap,
+}
+
+
+def compile_predicate(predicate):
+    """Compiles a predicate rule definition into a function of a resource
+
+    A predicate is one of:
+        {"path": P, "op": OP, "value": V} - true if any value at path P satisfies OP
+        {"path": P, "op": "exists"} - true if path P resolves to a value
+        {"all": [predicates]}, {"any": [predicates]}, {"not": predicate}
+        {"each": P, "match": predicate} - true if any value at path P satisfies
+            the predicate, with paths in the predicate relative to that value
+
+    OP is one of equals, not_equals, in, regex, in_cidr, contains_cidr and
+    port_overlap.
+
+    Args:
+        predicate: The decoded predicate definition
+
+    Returns:
+        A function taking a template node and returning True when it matches
+
+    Raises:
+        RuleRejected: If the predicate is malformed or uses an unknown operator
+
+    """
+    if not isinstance(predicate, dict):
+        raise RuleRejected("a predicate must be an object, not " + json.dumps(predicate))
+    for combinator in ('all', 'any'):
+        if combinator in predicate:
+            if not isinstance(predicate[combinator], list) or not predicate[combinator]:
+                raise RuleRejected('"{0}" must be a non-empty list of predicates'.format(combinator))
+            parts = [compile_predicate(p) for p in predicate[combinator]]
+            if combinator == 'all':
+                return lambda node: all(part(node) for part in parts)
+            return lambda node: any(part(node) for part in parts)
+    if 'not' in predicate:
+        part = compile_predicate(predicate['not'])
+        return lambda node: not part(node)
+    if 'each' in predicate:
+        path = predicate['each']
+        if not isinstance(path, (str, type(u''))) or 'match' not in predicate:
+            raise RuleRejected('"each" must be a path with a "match" predicate')
+        part = compile_predicate(predicate['match'])
+        return lambda node: any(part(value) for value in resolve_path(node, path))
+
+    path = predicate.get('path', '')
+    if not isinstance(path, (str, type(u''))):
+        raise RuleRejected('"path" must be a string, not ' + json.dumps(path))
+    if predicate.get('op') == 'exists':
+        expected = predicate.get('value', True)
+        return lambda node: bool(resolve_path(node, path)) == expected
+    if predicate.get('op') not in PREDICATE_OPERATORS:
+        raise RuleRejected('unknown predicate operator "{0}"'.format(predicate.get('op')))
+    operator = PREDICATE_OPERATORS[predicate['op']]
+    expected = predicate.get('value')
+    if predicate['op'] == 'regex':
+        if not isinstance(expected, (str, type(u''))):
+            raise RuleRejected('the "regex" operator needs a string value')
+        pattern = compile_rule_pattern(expected)
+        return lambda node: any(pattern.match(str(value)) is not None for value in resolve_path(node, path))
+    if predicate['op'] == 'port_overlap':
+        try:
+            ports = [int(port) for port in _as_list(expected)]
+        except (TypeError, ValueError):
+            ports = []
+        if len(ports) != (2 if isinstance(expected, list) else 1):
+            raise RuleRejected('the "port_overlap" operator needs a port or a [from, to] list')
+    return lambda node: any(operator(value, expected) for value in resolve_path(node, path))
+
+
+class RuleRejected(Exception):
+    """Raised when a rule fails the checks made when rules are loaded"""
+
+
+class RuleTimeout(Exception):
+    """Raised when a regex rule runs past RULE_TIME_BUDGET on a resource"""
+
+
+def _raise_rule_timeout(signum, frame):
+    raise RuleTimeout()
+
+
+def lint_pattern(pattern):
+    """Looks for regex shapes known to backtrack exponentially
+
+    A repeat that is unbounded, nested inside another unbounded repeat, such
+    as (a+)+ or (.*,)*, lets the regex engine split the same text in
+    exponentially many ways before giving up on a match.
+
+    Args:
+        pattern: The compiled regular expression
+
+    Returns:
+        A description of the problem, or None if the pattern looks safe
+
+    """
+    repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) + \
+        ((sre_parse.POSSESSIVE_REPEAT,) if hasattr(sre_parse, 'POSSESSIVE_REPEAT') else ())
+
+    def walk(sequence, unboundedRepeat):
+        for op, av in sequence:
+            if op in repeats:
+                unbounded = av[1] == sre_parse.MAXREPEAT
+                if unbounded and unboundedRepeat:
+                    return "nested unbounded repeats"
+                problem = walk(av[2], unboundedRepeat or unbounded)
+            elif op == sre_parse.SUBPATTERN:
+                problem = walk(av[-1], unboundedRepeat)
+            elif op == sre_parse.BRANCH:
+                problem = next((p for p in (walk(branch, unboundedRepeat) for branch in av[1]) if p), None)
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                problem = walk(av[1], unboundedRepeat)
+            else:
+                problem = None
+            if problem:
+                return problem
+        return None
+
+    return walk(sre_parse.parse(pattern.pattern, pattern.flags), False)
+
+
+def compile_rule_pattern(ruledata):
+    """Compiles a rule's regular expression and lints it
+
+    Args:
+        ruledata: The regular expression
+
+    Returns:
+        The compiled pattern
+
+    Raises:
+        RuleRejected: If the pattern is invalid or has an exponential backtracking shape
+
+    """
+    try:
+        pattern = re.compile(ruledata)
+    except re.error as e:
+        raise RuleRejected("invalid regular expression: " + str(e))
+    problem = lint_pattern(pattern)
+    if problem:
+        raise RuleRejected(problem + " in " + ruledata)
+    return pattern
+
+
+class EvaluationProfile(object):
+    """Times every rule evaluation of one template and bounds regex rules
+
+    Records the evaluations, matches and seconds of each rule, and adds them
+    to the rule's measured cost. Used as a context manager on the main
+    thread, a regex match running past the time budget is aborted with a
+    timer signal. Signals can't be used on other threads, so there a match
+    running past the budget is only detected once it finishes. Either way
+    the rule is flagged and skipped for the rest of the evaluation, and the
+    template fails.
+
+    Args:
+        budget: The seconds a regex rule may spend on one resource, 0 for no
+            limit, or None for RULE_TIME_BUDGET
+
+    """
+    def __init__(self, budget=None):
+        self.budget = RULE_TIME_BUDGET if budget is None else budget
+        self.rules = {}
+        self.timedOut = []
+        self.armed = False
+        self.previousHandler = None
+
+    def __enter__(self):
+        if self.budget and hasattr(signal, 'setitimer'):
+            try:
+                self.previousHandler = signal.signal(signal.SIGALRM, _raise_rule_timeout)
+                self.armed = True
+            except ValueError:
+                # Not on the main thread
+                pass
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.armed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self.previousHandler)
+            self.armed = False
+        return False
+
+    def run(self, rule, resource, serialized):
+        """Checks a rule against a resource, recording its timing
+
+        Returns:
+            True if the rule matches; False if it doesn't, timed out or timed
+            out earlier in this evaluation
+
+        """
+        if rule.name in self.timedOut:
+            return False
+        timed = self.armed and rule.pattern is not None
+        isMatch = False
+        start = time.time()
+        try:
+            if timed:
+                signal.setitimer(signal.ITIMER_REAL, self.budget)
+            try:
+                isMatch = rule.matches(resource, serialized)
+            finally:
+                if timed:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except RuleTimeout:
+            pass
+        seconds = time.time() - start
+        rule.seconds += seconds
+        rule.evaluations += 1
+        stats = self.rules.setdefault(rule.name, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += 1 if isMatch else 0
+        stats[2] += seconds
+        if self.budget and seconds > self.budget and rule.pattern is not None:
+            print("Rule " + rule.name + " exceeded its time budget of " + str(self.budget) + "s and was skipped")
+            self.timedOut.append(rule.name)
+            return False
+        return isMatch
+
+    def summary(self):
+        """Lists the rules that took the most time, slowest first"""
+        slowest = sorted(self.rules.items(), key=lambda item: -item[1][2])[:RULE_PROFILE_SIZE]
+        return [{'rule': name, 'evaluations': stats[0], 'matches': stats[1], 'seconds': round(stats[2], 6)}
+                for name, stats in slowest]
+
+
+class Rule(object):
+    """An active validation rule, compiled for evaluation
+
+    Rules of ruletype "regex" match their pattern against the Python repr of
+    the resource, or of the values at the rule's optional rulepath. Rules of
+    ruletype "predicate" hold a JSON predicate (see compile_predicate) that
+    is evaluated directly on the parsed resource.
+
+    Rules apply to the exact resource types listed in their resourcetypes
+    attribute. Without it, SecurityGroup rules apply to every type containing
+    "SecurityGroup" and EC2Instance rules to every type containing
+    "EC2::Instance"; rules of other categories must list their types.
+
+    Args:
+        item: The DynamoDB item describing the rule
+
+    """
+    def __init__(self, item):
+        self.name = str(item['rule']['S'])
+        self.category = item['category']['S']
+        self.ruletype = item.get('ruletype', {'S': "regex"})['S']
+        self.ruledata = item['ruledata']['S']
+        self.riskvalue = int(item['riskvalue']['N'])
+        self.path = item['rulepath']['S'] if 'rulepath' in item else None
+        self.resourceTypes = None
+        if 'resourcetypes' in item:
+            resourceTypes = item['resourcetypes']
+            if 'SS' in resourceTypes:
+                self.resourceTypes = frozenset(resourceTypes['SS'])
+            elif 'L' in resourceTypes:
+                self.resourceTypes = frozenset(value['S'] for value in resourceTypes['L'])
+            else:
+                self.resourceTypes = frozenset(value.strip() for value in resourceTypes['S'].split(','))
+        self.pattern = None
+        self.predicate = None
+        if self.ruletype == "predicate":
+            try:
+                self.predicate = compile_predicate(json.loads(self.ruledata))
+            except ValueError as e:
+                raise RuleRejected("invalid predicate: " + str(e))
+        else:
+            self.pattern = compile_rule_pattern(self.ruledata)
+        # Measured cost of the rule, across the evaluations of a warm container
+        self.evaluations = 0
+        self.seconds = 0.0
+
+    def cost(self):
+        """The average measured seconds per evaluation of the rule, 0 until measured"""
+        return self.seconds / self.evaluations if self.evaluations else 0.0
+
+    def fail_fast_key(self):
+        """Orders rules for fail-fast evaluation: highest risk first, then cheapest"""
+        return -self.riskvalue, self.cost()
+
+    def applies_to(self, resourceType):
+        """Checks whether the rule applies to resources of the given Type"""
+        if self.resourceTypes is not None:
+            return resourceType in self.resourceTypes
+        if self.category == "SecurityGroup":
+            return "SecurityGroup" in resourceType
+        if self.category == "EC2Instance":
+            return "EC2::Instance" in resourceType
+        return False
+
+    def matches(self, resource, serialized):
+        """Checks the rule against a resource
+
+        Args:
+            resource: The parsed resource
+            serialized: Per-resource dictionary of already serialized subtrees, by path
+
+        Returns:
+            True if the rule matches the resource
+
+        """
+        if self.predicate is not None:
+            return self.predicate(resource)
+        texts = serialized.get(self.path)
+        if texts is None:
+            if self.path is None:
+                texts = [str(resource)]
+            else:
+                texts = [str(value) for value in resolve_path(resource, self.path)]
+            serialized[self.path] = texts
+        return any(self.pattern.match(text) is not None for text in texts)
+
+
+def required_literals(pattern):
+    """Extracts literal strings that every match of a compiled regex must contain
+
+    Only literals outside optional and case-insensitive parts of the pattern
+    are collected, so a text lacking any one of them can't match the pattern.
+
+    Args:
+        pattern: The compiled regular expression
+
+    Returns:
+        The list of required literal strings, possibly empty
+
+    """
+    if pattern.flags & re.IGNORECASE:
+        return []
+    literals = []
+
+    def collect(sequence):
+        current = []
+        for op, av in sequence:
+            if op == sre_parse.LITERAL and av < 128:
+                current.append(chr(av))
+                continue
+            literals.append(''.join(current))
+            current = []
+            if op == sre_parse.SUBPATTERN:
+                # Literals in a scoped (?i:...) group match in any case
+                if len(av) < 4 or not av[1] & re.IGNORECASE:
+                    collect(av[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                collect(av[2])
+        literals.append(''.join(current))
+
+    collect(sre_parse.parse(pattern.pattern, pattern.flags))
+    return sorted(set(literal for literal in literals if len(literal) >= PREFILTER_MIN_LITERAL))
+
+
+class RuleMatcher(object):
+    """Matches all rules of a category against a resource in a single pass
+
+    The required literals of every whole-resource regex rule are combined
+    into one prefilter pattern. Each resource is scanned once to find which
+    literals it contains, and only the rules whose literals are all present
+    run their full regex. Predicate rules, rules with a rulepath and regexes
+    without usable literals are always checked.
+
+    Args:
+        rules: The compiled rules of the category, in evaluation order
+
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.literals = {}
+        for rule in rules:
+            if rule.pattern is not None and rule.path is None:
+                literals = required_literals(rule.pattern)
+                if literals:
+                    self.literals[rule] = literals
+        allLiterals = sorted(set(literal for literals in self.literals.values() for literal in literals),
+                             key=len, reverse=True)
+        self.prefilter = None
+        if allLiterals:
+            # The lookahead finds the longest literal at every position; shorter
+            # literals starting at the same position are substrings of it
+            self.prefilter = re.compile('(?=(' + '|'.join(re.escape(literal) for literal in allLiterals) + '))')
+        self.substrings = dict((literal, [other for other in allLiterals if other in literal])
+                               for literal in allLiterals)
+
+    def match(self, resource, serialized, riskBudget=None, profile=None):
+        """Finds the rules matching a resource
+
+        Args:
+            resource: The parsed resource
+            serialized: Per-resource dictionary of already serialized subtrees, by path
+            riskBudget: In fail-fast mode, the risk left until the failure
+                threshold. Rules are then tried by descending riskvalue and
+                ascending measured cost, and matching stops as soon as the
+                risk of the matched rules reaches the budget.
+            profile: The EvaluationProfile timing the rules
+
+        Returns:
+            The list of matching rules, in evaluation order
+
+        """
+        found = None
+        if self.prefilter is not None:
+            if None not in serialized:
+                serialized[None] = [str(resource)]
+            found = set()
+            for literal in set(self.prefilter.findall(serialized[None][0])):
+                found.update(self.substrings[literal])
+        if profile is None:
+            profile = EvaluationProfile(0)
+        matched = []
+        matchedRisk = 0
+        for rule in self.rules if riskBudget is None else sorted(self.rules, key=Rule.fail_fast_key):
+            literals = self.literals.get(rule)
+            if literals is not None and not all(literal in found for literal in literals):
+                continue
+            if profile.run(rule, resource, serialized):
+                matched.append(rule)
+                matchedRisk = matchedRisk + rule.riskvalue
+                if riskBudget is not None and matchedRisk >= riskBudget:
+                    break
+        return matched
+
+
+class RuleSet(object):
+    """The active rules of one rule-set version, compiled once for reuse
+
+    Resources are dispatched by their exact Type. The first resource of a
+    Type builds a RuleMatcher over just the rules applying to that Type, and
+    every later resource of the Type reuses it.
+
+    Args:
+        rules: The rules dictionary returned by get_rules()
+        version: The rule-set version the compiled rules belong to
+
+    """
+    def __init__(self, rules, version):
+        self.version = version
+        self.rules = []
+        self.rejected = []
+        for item in rules['sgRules'] + rules['ec2Rules'] + rules.get('otherRules', []):
+            if item['active']['S'] != "Y":
+                continue
+            try:
+                self.rules.append(Rule(item))
+            except RuleRejected as e:
+                print("Rejected rule " + str(item['rule']['S']) + ": " + str(e))
+                self.rejected.append(str(item['rule']['S']))
+        self.typeIndex = {}
+
+    def matcher_for(self, resourceType):
+        """Gets the RuleMatcher for the rules applying to a resource Type
+
+        Args:
+            resourceType: The exact Type of the resource
+
+        Returns:
+            The RuleMatcher, holding no rules if none apply
+
+        """
+        matcher = self.typeIndex.get(resourceType)
+        if matcher is None:
+            matcher = RuleMatcher([rule for rule in self.rules if rule.applies_to(resourceType)])
+            self.typeIndex[resourceType] = matcher
+        return matcher
+
+    def __str__(self):
+        return "RuleSet " + self.version + ": " + str([rule.name for rule in self.rules]) + \
+            (", rejected: " + str(self.rejected) if self.rejected else "")
+
+
+def rule_set_version(rules):
+    """Fingerprints the rule items so a changed rule set gets a new version
+
+    Args:
+        rules: The rules dictionary returned by get_rules()
+
+    Returns:
+        A hex digest identifying the rule set
+
+    """
+    # Sorted by rule name, as scans don't promise an order
+    items = dict((category, sorted(rules.get(category, []), key=lambda item: item['rule']['S']))
+                 for category in ('sgRules', 'ec2Rules', 'otherRules'))
+    return hashlib.sha256(json.dumps(items, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compile_rules(rules):
+    """Returns the compiled RuleSet for the rules, reusing a cached one when possible
+
+    Args:
+        rules: The rules dictionary returned by get_rules(), or an already compiled RuleSet
+
+    Returns:
+        The compiled RuleSet
+
+    """
+    if isinstance(rules, RuleSet):
+        return rules
+    version = rule_set_version(rules)
+    ruleSet = _rule_set_cache.get(version)
+    if ruleSet is None:
+        ruleSet = RuleSet(rules, version)
+        if len(_rule_set_cache) >= RULE_SET_CACHE_SIZE:
+            _rule_set_cache.clear()
+        _rule_set_cache[version] = ruleSet
+    return ruleSet
+
+
+class MemoryVerdictCache(object):
+    """Verdict cache held in memory, used by warm containers and in tests
+
+    Args:
+        maxEntries: The number of verdicts kept before the cache is cleared
+
+    """
+    def __init__(self, maxEntries=10000):
+        self.maxEntries = maxEntries
+        self.verdicts = {}
+
+    def get_many(self, keys):
+        return dict((key, self.verdicts[key]) for key in keys if key in self.verdicts)
+
+    def put_many(self, verdicts):
+        if len(self.verdicts) + len(verdicts) > self.maxEntries:
+            self.verdicts.clear()
+        self.verdicts.update(verdicts)
+
+
+class FileVerdictCache(MemoryVerdictCache):
+    """Verdict cache persisted to a local JSON file, a stand-in for the DynamoDB cache
+
+    Args:
+        path: The JSON file holding the verdicts
+
+    """
+    def __init__(self, path):
+        MemoryVerdictCache.__init__(self)
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as cacheFile:
+                self.verdicts = json.load(cacheFile)
+
+    def put_many(self, verdicts):
+        MemoryVerdictCache.put_many(self, verdicts)
+        with open(self.path, 'w') as cacheFile:
+            json.dump(self.verdicts, cacheFile)
+
+
+class DynamoDBVerdictCache(object):
+    """Verdict cache stored in a DynamoDB table with a string hash key named 'key'
+
+    Failing cache reads and writes are logged and treated as cache misses, so
+    they never fail a validation.
+
+    Args:
+        table: The name of the table
+        client: The DynamoDB client to use
+
+    """
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client or get_client('dynamodb')
+
+    def get_many(self, keys):
+        verdicts = {}
+        keys = list(keys)
+        try:
+            for n in range(0, len(keys), 100):
+                request = {self.table: {'Keys': [{'key': {'S': key}} for key in keys[n:n + 100]]}}
+                while request:
+                    response = self.client.batch_get_item(RequestItems=request)
+                    for item in response['Responses'].get(self.table, []):
+                        verdicts[item['key']['S']] = json.loads(item['verdict']['S'])
+                    request = response.get('UnprocessedKeys')
+        except botocore.exceptions.ClientError as e:
+            print("Verdict cache read failed: " + str(e))
+        return verdicts
+
+    def put_many(self, verdicts):
+        expires = str(int(time.time()) + VERDICT_CACHE_DAYS * 86400)
+        requests = [{'PutRequest': {'Item': {
+            'key': {'S': key},
+            'verdict': {'S': json.dumps(verdict)},
+            'expires': {'N': expires}}}} for key, verdict in verdicts.items()]
+        try:
+            for n in range(0, len(requests), 25):
+                request = {self.table: requests[n:n + 25]}
+                while request:
+                    request = self.client.batch_write_item(RequestItems=request).get('UnprocessedItems')
+        except botocore.exceptions.ClientError as e:
+            print("Verdict cache write failed: " + str(e))
+
+
+def get_verdict_cache():
+    """Gets the verdict cache, in DynamoDB when VERDICT_CACHE_TABLE is configured
+
+    Returns:
+        The verdict cache, kept for the lifetime of the container
+
+    """
+    global _verdict_cache
+    if _verdict_cache is None:
+        if VERDICT_CACHE_TABLE:
+            _verdict_cache = DynamoDBVerdictCache(VERDICT_CACHE_TABLE)
+        else:
+            _verdict_cache = MemoryVerdictCache()
+    return _verdict_cache
+
+
+def content_hash(data):
+    """Hashes template or resource content for verdict cache keys
+
+    Args:
+        data: The raw template bytes, or a parsed resource
+
+    Returns:
+        The hex SHA-256 digest
+
+    """
+    if not isinstance(data, bytes):
+        data = json.dumps(data, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class HashingReader(object):
+    """Wraps a file object and hashes everything read through it
+
+    Args:
+        fileobj: The file object to read from
+
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        """Reads whatever is left and returns the hex SHA-256 digest of the whole content"""
+        while self.read(STREAMING_CHUNK):
+            pass
+        return self.digest.hexdigest()
+
+
+class TemplateStream(object):
+    """Incremental reader of a JSON document, decoding one value at a time
+
+    Only the text of the value being decoded is held in memory. Values that
+    aren't needed are skipped by scanning for brackets and quotes without
+    decoding them.
+
+    Args:
+        fileobj: The binary file object holding the UTF-8 encoded JSON
+
+    """
+    DECODER = json.JSONDecoder()
+    STRUCTURE = re.compile(r'["{}\[\]]')
+    STRING_END = re.compile(r'["\\]')
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=STREAMING_CHUNK):
+        """Reads more of the document, dropping the text already consumed
+
+        Returns:
+            False at the end of the document
+
+        """
+        if self.eof:
+            return False
+        data = self.fileobj.read(size)
+        self.eof = not data
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(data, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """Skips whitespace and returns the next character"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in u' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of template')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected "{0}" in template, found "{1}"'.format(char, self.peek()))
+        self.pos += 1
+
+    def next_is(self, char):
+        """Consumes the next character if it is char"""
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        """Decodes the next JSON value"""
+        size = STREAMING_CHUNK
+        while True:
+            first = self.peek()
+            try:
+                value, end = self.DECODER.raw_decode(self.buffer, self.pos)
+                # A number or literal is only complete once a character that can't
+                # continue it follows, as in -2500 followed by .5 in the next chunk
+                if first in u'{["' or self.eof or (end < len(self.buffer) and self.buffer[end] in u' \t\r\n,:]}'):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Read ever larger chunks so a large value isn't decoded over and over
+            self.fill(size)
+            size = size * 2
+
+    def skip_value(self):
+        """Skips the next JSON value without decoding it"""
+        if self.peek() not in u'{[':
+            self.value()
+            return
+        depth = 0
+        inString = False
+        while True:
+            match = (self.STRING_END if inString else self.STRUCTURE).search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                if not self.fill():
+                    raise ValueError('Unexpected end of template')
+                continue
+            char = match.group()
+            if char == u'\\':
+                if match.end() >= len(self.buffer):
+                    # The escaped character is in the next chunk
+                    self.pos = match.start()
+                    if not self.fill():
+                        raise ValueError('Unexpected end of template')
+                    continue
+                self.pos = match.end() + 1
+                continue
+            self.pos = match.end()
+            if char == u'"':
+                inString = not inString
+            elif char in u'{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+
+def iter_template_resources(fileobj):
+    """Parses the Resources of a JSON template one resource at a time
+
+    Args:
+        fileobj: The binary file object holding the template
+
+    Yields:
+        (logicalId, resource) tuples in template order
+
+    Raises:
+        KeyError: If the template has no Resources section
+        ValueError: If the template is not valid JSON
+
+    """
+    stream = TemplateStream(fileobj)
+    foundResources = False
+    stream.expect(u'{')
+    if stream.next_is(u'}'):
+        raise KeyError('Resources')
+    while True:
+        key = stream.value()
+        stream.expect(u':')
+        if key == 'Resources':
+            foundResources = True
+            stream.expect(u'{')
+            if not stream.next_is(u'}'):
+                while True:
+                    logicalId = stream.value()
+                    stream.expect(u':')
+                    yield logicalId, stream.value()
+                    if not stream.next_is(u','):
+                        break
+                stream.expect(u'}')
+        else:
+            stream.skip_value()
+        if not stream.next_is(u','):
+            break
+    stream.expect(u'}')
+    if not foundResources:
+        raise KeyError('Resources')
+
+
+def resources_fingerprint(resourceHashes):
+    """Identifies a set of resources by their logical IDs and contents
+
+    Args:
+        resourceHashes: A dictionary of logical ID to content_hash() of the resource
+
+    Returns:
+        The hex SHA-256 digest, independent of the order of the resources
+
+    """
+    lines = sorted(logicalId + ":" + resourceHash for logicalId, resourceHash in resourceHashes.items())
+    return hashlib.sha256("\n".join(lines).encode('utf-8')).hexdigest()
+
+
+class StackBaseline(object):
+    """The resources of the deployed stack a template is an update to
+
+    Resources whose logical ID and content match the deployed stack carry
+    over their verdict from the evaluation of the deployed template, and
+    resources listed in a change set are always evaluated.
+
+    Args:
+        resources: The Resources of the deployed template, or None for a new stack
+        changed: The logical IDs the change set adds or modifies
+
+    """
+    def __init__(self, resources=None, changed=None):
+        self.hashes = dict((logicalId, content_hash(resource)) for logicalId, resource in (resources or {}).items())
+        self.fingerprint = resources_fingerprint(self.hashes) if resources is not None else None
+        self.changed = changed or set()
+
+    def unchanged(self, logicalId, resourceHash):
+        return logicalId not in self.changed and self.hashes.get(logicalId) == resourceHash
+
+
+def get_stack_baseline(stackName, changeSetName=None):
+    """Gets the deployed template of a stack to scope the evaluation to what changed
+
+    Args:
+        stackName: The name or ID of the stack the template updates
+        changeSetName: An optional change set of the update
+
+    Returns:
+        The StackBaseline. It has no resources for a stack that doesn't exist
+        yet or whose template is not JSON, so every resource is evaluated.
+
+    Raises:
+        Exception: Any exception thrown while reading the stack or the change set
+
+    """
+    try:
+        body = get_client('cloudformation').get_template(StackName=stackName, TemplateStage='Original')['TemplateBody']
+    except botocore.exceptions.ClientError as e:
+        if 'does not exist' not in str(e):
+            raise
+        print("Stack " + stackName + " does not exist, evaluating every resource")
+        return StackBaseline()
+    # JSON templates are returned parsed, YAML ones as a string
+    if not isinstance(body, dict):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            print("Deployed template of " + stackName + " is not JSON, evaluating every resource")
+            return StackBaseline()
+
+    changed = set()
+    if changeSetName:
+        kwargs = {'StackName': stackName, 'ChangeSetName': changeSetName}
+        while True:
+            response = get_client('cloudformation').describe_change_set(**kwargs)
+            for change in response.get('Changes', []):
+                resourceChange = change.get('ResourceChange', {})
+                if resourceChange.get('Action') != 'Remove':
+                    changed.add(resourceChange.get('LogicalResourceId'))
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+    return StackBaseline(body.get('Resources', {}), changed)
+
+
+def hash_resources(resources, resourceHashes):
+    """Passes (logicalId, resource) tuples through, recording the content_hash() of each resource"""
+    for logicalId, resource in resources:
+        resourceHashes[logicalId] = content_hash(resource)
+        yield logicalId, resource
+
+
+def applicable_resources(ruleSet, resources, batchSize):
+    """Pairs resources with the matcher of their Type, skipping those no rule applies to
+
+    Args:
+        ruleSet: The compiled RuleSet
+        resources: An iterable of (logicalId, resource) tuples
+        batchSize: The number of resources per batch
+
+    Yields:
+        Lists of up to batchSize (logicalId, resource, matcher) tuples
+
+    """
+    batch = []
+    for logicalId, resource in resources:
+        resourceType = resource.get('Type') if isinstance(resource, dict) else None
+        if isinstance(resourceType, (str, type(u''))):
+            matcher = ruleSet.matcher_for(resourceType)
+            if matcher.rules:
+                batch.append((logicalId, resource, matcher))
+                if len(batch) >= batchSize:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def evaluate_template(rules, template, cache=None, failFast=False, baseline=None):
+    """Evaluates the template against the rules
+
+    The template is either its raw content or, for templates too large to
+    hold parsed in memory, a file object. A file object is parsed and
+    evaluated one resource at a time, so only the resources being evaluated
+    are held in memory.
+
+    With a verdict cache, a template whose content was already evaluated
+    against the same rule-set version is not evaluated again, and otherwise
+    only the resources without a cached verdict are. Cache keys include the
+    rule-set version, so changing the rules invalidates every verdict. The
+    content of a streamed template is only known once it has been read, so
+    only its resource verdicts can be looked up.
+
+    With a cache and the baseline of the stack the template updates, the
+    verdict of each resource is also recorded for the whole set of
+    resources. When the deployed template was evaluated before, resources
+    left unchanged by the update carry over its verdict, and only the added
+    and modified ones are evaluated.
+
+    A regex rule running past RULE_TIME_BUDGET on a resource fails the
+    template: the risk is raised to at least FAILURE_THRESHOLD, so input
+    crafted to make the rules slow can't get a template through.
+
+    In fail-fast mode evaluation stops as soon as the risk reaches
+    FAILURE_THRESHOLD, trying the riskiest and cheapest rules first. The
+    failed rules then only list the matches found until that point, and the
+    incomplete verdict is not cached.
+
+    Args:
+        rules: The rules dictionary returned by get_rules(), or a compiled RuleSet
+        template: The CloudFormation template as a string, or a binary file object
+        cache: An optional verdict cache, such as the one from get_verdict_cache()
+        failFast: Stop evaluating once the template is known to fail
+        baseline: An optional StackBaseline from get_stack_baseline()
+
+    Returns:
+        The accumulated risk value and the names of the failed rules
+
+    """
     # Validate rules and increase risk value
     risk = 0
-    # Extract Security Group Resources
-    sgResources = []
-    ec2Resources = []
     failedRules = []
-    jsonTemplate = json.loads(template)
-    print(json.dumps(jsonTemplate, sort_keys=True, indent=4, separators=(',', ': ')))
-    print(rules)
-    for key in jsonTemplate['Resources'].keys():
-        if "SecurityGroup" in jsonTemplate['Resources'][key]['Type']:
-            sgResources.append(jsonTemplate['Resources'][key])
-        elif "EC2::Instance" in jsonTemplate['Resources'][key]['Type']:
-            ec2Resources.append(jsonTemplate['Resources'][key])
-
-    for n in range(len(sgResources)):
-        for m in range(len(rules['sgRules'])):
-            if rules['sgRules'][m]['active']['S'] == "Y":
-                if re.match(rules['sgRules'][m]['ruledata']['S'], str(sgResources[n])):
-                    risk = risk + int(rules['sgRules'][m]['riskvalue']['N'])
-                    failedRules.append(str(rules['sgRules'][m]['rule']['S']))
-                    print("Matched rule: " + str(rules['sgRules'][m]['rule']['S']))
-                    print("Resource: " + str(sgResources[n]))
-                    print("Riskvalue: " + rules['sgRules'][m]['riskvalue']['N'])
-                    print("")
-
-    for n in range(len(ec2Resources)):
-        for m in range(len(rules['ec2Rules'])):
-            if rules['ec2Rules'][m]['active']['S'] == "Y":
-                if re.match(rules['ec2Rules'][m]['ruledata']['S'], str(ec2Resources[n])):
-                    risk = risk + int(rules['ec2Rules'][m]['riskvalue']['N'])
-                    failedRules.append(str(rules['ec2Rules'][m]['rule']['S']))
-                    print("Matched rule: " + str(rules['ec2Rules'][m]['rule']['S']))
-                    print("Resource: " + str(ec2Resources[n]))
-                    print("Riskvalue: " + rules['ec2Rules'][m]['riskvalue']['N'])
-                    print("")
+    ruleSet = compile_rules(rules)
+    print(ruleSet)
+    if hasattr(template, 'read'):
+        template = HashingReader(template)
+        resources = iter_template_resources(template)
+        templateKey = None
+    else:
+        templateKey = "template:" + ruleSet.version + ":" + content_hash(template)
+        if cache is not None:
+            verdict = cache.get_many([templateKey]).get(templateKey)
+            if verdict is not None:
+                print("Cached risk value: " + str(verdict['risk']))
+                return verdict['risk'], verdict['failedRules']
+        resources = json.loads(template)['Resources'].items()
+
+    # Hashes of every resource, and verdicts by logical ID, recorded for the stack
+    resourceHashes = {}
+    stackVerdicts = {}
+    prior = None
+    if cache is None:
+        baseline = None
+    elif baseline is not None:
+        resources = hash_resources(resources, resourceHashes)
+        if baseline.fingerprint is not None:
+            priorKey = "stack:" + ruleSet.version + ":" + baseline.fingerprint
+            prior = cache.get_many([priorKey]).get(priorKey)
+            if prior is None:
+                print("Deployed template was not evaluated before, evaluating every resource")
+
+    verdicts = {}
+    stopped = False
+    with EvaluationProfile() as profile:
+        for batch in applicable_resources(ruleSet, resources, VERDICT_BATCH_SIZE if cache is not None else 1):
+            resourceKeys = {}
+            cached = {}
+            if cache is not None:
+                for logicalId, resource, _ in batch:
+                    resourceHash = resourceHashes.get(logicalId) or content_hash(resource)
+                    if prior is not None and baseline.unchanged(logicalId, resourceHash):
+                        # Resources the deployed template recorded no verdict for had no risk
+                        cached[logicalId] = prior['resources'].get(logicalId, {'risk': 0, 'failedRules': []})
+                    else:
+                        resourceKeys[logicalId] = "resource:" + ruleSet.version + ":" + resourceHash
+                found = cache.get_many(set(resourceKeys.values()))
+                for logicalId, key in resourceKeys.items():
+                    if key in found:
+                        cached[logicalId] = found[key]
+
+            for logicalId, resource, matcher in batch:
+                verdict = cached.get(logicalId)
+                if verdict is None:
+                    riskBudget = FAILURE_THRESHOLD - risk if failFast else None
+                    verdict = {'risk': 0, 'failedRules': []}
+                    for rule in matcher.match(resource, {}, riskBudget, profile):
+                        verdict['risk'] = verdict['risk'] + rule.riskvalue
+                        verdict['failedRules'].append(rule.name)
+                        print("Matched rule: " + rule.name)
+                        print("Resource: " + str(resource))
+                        print("Riskvalue: " + str(rule.riskvalue))
+                        print("")
+                    # A resource that reached the risk budget may not have been checked against
+                    # every rule. Once a rule timed out it is skipped for every later resource,
+                    # so none of them is fully checked either
+                    if cache is not None and (riskBudget is None or verdict['risk'] < riskBudget) and \
+                            not profile.timedOut:
+                        verdicts[resourceKeys[logicalId]] = verdict
+                if verdict['risk']:
+                    stackVerdicts[logicalId] = verdict
+                risk = risk + verdict['risk']
+                failedRules.extend(verdict['failedRules'])
+                if failFast and (risk >= FAILURE_THRESHOLD or profile.timedOut):
+                    stopped = True
+                    break
+            if stopped:
+                break
+    print("Rule profile: " + json.dumps(profile.summary()))
+    if profile.timedOut:
+        failedRules.extend(name + " (timed out)" for name in profile.timedOut)
+        # The template wasn't fully checked against the rules that timed out, so it fails
+        risk = max(risk, FAILURE_THRESHOLD)
+    if stopped:
+        print("Risk value: " + str(risk) + ", stopped evaluating in fail-fast mode")
+        if cache is not None:
+            cache.put_many(verdicts)
+        return risk, failedRules
     print("Risk value: " +str(risk))
+    if cache is not None:
+        if not profile.timedOut:
+            if templateKey is None:
+                templateKey = "template:" + ruleSet.version + ":" + template.hexdigest()
+            verdicts[templateKey] = {'risk': risk, 'failedRules': failedRules}
+        cache.put_many(verdicts)
+        if baseline is not None and not profile.timedOut:
+            # Stored on its own, as it can be large and a failed write would take other verdicts with it
+            stackKey = "stack:" + ruleSet.version + ":" + resources_fingerprint(resourceHashes)
+            cache.put_many({stackKey: {'risk': risk, 'resources': stackVerdicts}})
     return risk, failedRules
 
-def s3_next_step(s3, bucket, risk, failedRules, template, job_id):
-    # Store data in temporary physical file
-    s3Client = boto3.client('s3', config=botocore.client.Config(signature_version='s3v4'))
-    tmp_file = tempfile.NamedTemporaryFile()
-    tmp_zip = tempfile.NamedTemporaryFile()
-    for item in template:
-        tmp_file.write(item)
-    tmp_file.flush()
+
+def get_output_s3_client():
+    """Gets the pooled S3 client used to write to the output bucket
+
+    The artifact credentials from setup_s3_client only grant access to the
+    artifact store, so outputs are written with the function's own role.
+
+    Returns:
+        The S3 client
+
+    """
+    global _output_s3
+    if _output_s3 is None:
+        _output_s3 = boto3.client('s3', config=botocore.client.Config(signature_version='s3v4'))
+    return _output_s3
+
+
+def get_output_encryption(params):
+    """Builds the server-side encryption arguments for output uploads
+
+    Args:
+        params: The decoded UserParameters, optionally holding "sse" (AES256 or
+            aws:kms) and "kmsKeyId"
+
+    Returns:
+        The extra put_object arguments, empty if no encryption was requested
+
+    """
+    encryption = {}
+    if params.get('sse'):
+        encryption['ServerSideEncryption'] = params['sse']
+    if params.get('kmsKeyId'):
+        encryption['ServerSideEncryption'] = params.get('sse') or 'aws:kms'
+        encryption['SSEKMSKeyId'] = params['kmsKeyId']
+    return encryption
+
+
+def package_template(template, name):
+    """Zips the template in memory
+
+    Args:
+        template: The template contents, a list of (path, template) tuples
+            to store each template under its own path, or a function opening
+            the template as a file object
+        name: The file name of a single template within the zip
+
+    Returns:
+        The zip file contents
+
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip:
+        if isinstance(template, list):
+            for path, contents in template:
+                zip.writestr(path, contents)
+        elif callable(template):
+            with template() as source:
+                if sys.version_info >= (3, 6):
+                    # Compress as it is read, without holding the uncompressed template
+                    with zip.open(name, 'w') as target:
+                        shutil.copyfileobj(source, target, STREAMING_CHUNK)
+                else:
+                    zip.writestr(name, source.read())
+        else:
+            zip.writestr(name, template)
+    return buffer.getvalue()
+
+
+def template_digest(template):
+    """Hashes the template contents for content-addressed output keys
+
+    Args:
+        template: The template contents, a list of (path, template) tuples, or
+            a function opening the template
+
+    Returns:
+        The hex SHA-256 digest
+
+    """
+    digest = hashlib.sha256()
+    if isinstance(template, list):
+        for path, contents in template:
+            digest.update((path + "\n" + content_hash(contents) + "\n").encode('utf-8'))
+    elif callable(template):
+        with template() as source:
+            for chunk in iter(lambda: source.read(STREAMING_CHUNK), b''):
+                digest.update(chunk)
+    else:
+        digest.update(template)
+    return digest.hexdigest()
+
+
+def object_exists(s3Client, bucket, key):
+    """Checks for an object with a HEAD request
+
+    Raises:
+        Exception: Any exception thrown by .head_object() other than a missing key
+
+    """
+    try:
+        s3Client.head_object(Bucket=bucket, Key=key)
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def get_execution_id(job_id):
+    """Gets the ID of the pipeline execution a job belongs to
+
+    Args:
+        job_id: The CodePipeline job ID
+
+    Returns:
+        The pipeline execution ID, or the job ID if it can't be read
+
+    """
+    try:
+        return get_client('codepipeline').get_job_details(jobId=job_id)['jobDetails']['data']['pipelineContext']['pipelineExecutionId']
+    except (botocore.exceptions.ClientError, KeyError) as e:
+        print("Pipeline execution ID not available, using the job ID: " + str(e))
+        return job_id
+
+
+def s3_next_step(bucket, risk, failedRules, template, job_id, encryption=None, layout="fixed"):
+    """Routes the template based on its risk value
+
+    Low risk templates are stored as valid.template.zip and medium risk ones as
+    flagged.template.zip in the output bucket. High risk templates fail the job.
+
+    With the "content" layout, templates are instead stored under
+    templates/valid/ or templates/flagged/ with the hash of their contents as
+    the key, and not uploaded again if that key already exists. A manifest at
+    executions/<pipeline execution ID>.json records the result of each
+    execution and the key of its template, so pipelines sharing the bucket
+    don't overwrite each other's output.
+
+    Args:
+        bucket: The output bucket
+        risk: The accumulated risk value of the template
+        failedRules: The names of the rules the template failed
+        template: The template contents, a list of (path, template) tuples, or
+            a function opening the template
+        job_id: The CodePipeline job ID
+        encryption: Optional server-side encryption arguments for the upload
+        layout: "fixed" or "content"
+
+    """
+    s3Client = get_output_s3_client()
+    encryption = encryption or {}
     # Process file based on risk value
-    if risk < 5:
-        with zipfile.ZipFile(tmp_zip.name, 'w') as zip:
-            zip.write(tmp_file.name, "valid.template.json")
-            zip.close()
-            s3Client.upload_file( # Add encryption support
-                tmp_zip.name,
-                bucket,
-                'valid.template.zip')
-        tmp_file.close()
+    if risk < FLAGGED_THRESHOLD:
+        result = 'valid'
+    elif FLAGGED_THRESHOLD <= risk < FAILURE_THRESHOLD:
+        result = 'flagged'
+    else:
+        result = 'failed'
+
+    key = None
+    if result != 'failed':
+        if layout == "content":
+            key = 'templates/' + result + '/' + template_digest(template) + '.zip'
+            upload = not object_exists(s3Client, bucket, key)
+            if not upload:
+                print("Template already stored as " + key)
+        else:
+            key = result + '.template.zip'
+            upload = True
+        if upload:
+            s3Client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=package_template(template, result + ".template.json"),
+                **encryption)
+
+    if layout == "content":
+        execution_id = get_execution_id(job_id)
+        manifest = {'execution': execution_id, 'job': job_id, 'result': result, 'risk': risk, 'key': key}
+        s3Client.put_object(
+            Bucket=bucket,
+            Key='executions/' + execution_id + '.json',
+            Body=json.dumps(manifest, sort_keys=True).encode('utf-8'),
+            ContentType='application/json',
+            **encryption)
+
+    if result == 'valid':
         put_job_success(job_id, 'Job succesful, minimal or no risk detected.')
-    elif 5 <= risk < 50:
-        with zipfile.ZipFile(tmp_zip.name, 'w') as zip:
-            zip.write(tmp_file.name, "flagged.template.json")
-            zip.close()
-            s3Client.upload_file( # Add encryption support
-                tmp_zip.name,
-                bucket,
-                'flagged.template.zip')
-        tmp_file.close()
+    elif result == 'flagged':
         put_job_success(job_id, 'Job succesful, medium risk detected, manual approval needed.')
-    elif risk >= 50:
-        tmp_file.close()
+    else:
         print("High risk file, fail pipeline")
         put_job_failure(job_id, 'Function exception: Failed filters ' + str(failedRules))
     return 0
 
 
+def evaluate_templates(rules, templates, cache=None, failFast=False):
+    """Evaluates several templates against one compiled rule set
+
+    Templates are evaluated one after another on the calling thread.
+    Evaluation is regex work that holds the GIL, so threads wouldn't speed
+    it up, and RULE_TIME_BUDGET can only interrupt rules on the main thread.
+
+    Args:
+        rules: The rules dictionary returned by get_rules(), or a compiled RuleSet
+        templates: A list of (path, template) tuples
+        cache: An optional verdict cache shared by the evaluations
+        failFast: Stop evaluating each template once it is known to fail
+
+    Returns:
+        The overall risk, which is the highest risk of any template, the
+        failed rules prefixed with the path of their template, and a list of
+        (path, risk, failedRules) tuples for the individual templates
+
+    """
+    ruleSet = compile_rules(rules)
+    risks = [evaluate_template(ruleSet, template, cache, failFast) for _, template in templates]
+    results = []
+    failedRules = []
+    for (path, _), (templateRisk, templateFailedRules) in zip(templates, risks):
+        print("Template " + path + " risk value: " + str(templateRisk))
+        results.append((path, templateRisk, templateFailedRules))
+        failedRules.extend(path + ": " + rule for rule in templateFailedRules)
+    return max(result[1] for result in results), failedRules, results
+
+
 def lambda_handler(event, context):
     """The Lambda function handler
 
@@ -383,6 +2026,10 @@ def lambda_handler(event, context):
         input_artifact = params['input']
         template_file = params['file']
         output_bucket = params['output']
+        # "fail-fast" stops evaluating once the template is known to fail, "full" reports every failed rule
+        fail_fast = params.get('mode', "full") == "fail-fast"
+        # "content" stores templates under content-addressed keys with a manifest per pipeline execution
+        output_layout = params.get('outputLayout', "fixed")
 
         # Get the artifact details
         input_artifact_data = find_artifact(input_artifacts, input_artifact)
@@ -390,18 +2037,38 @@ def lambda_handler(event, context):
         # Get S3 client to access artifact with
         s3 = setup_s3_client(job_data)
 
-        # Get the JSON template file out of the artifact
-        template = get_template(s3, input_artifact_data, template_file)
-        print("Template: " + template)
-
         # Get validation rules from DDB
         rules = get_rules()
 
-        # Validate template from risk perspective. FailedRules can be used if you wish to expand the script to report failed items
-        risk, failedRules = evaluate_template(rules, template)
-
-        # Based on risk, store the template in the correct S3 bucket for future process
-        s3_next_step(s3, output_bucket, risk, failedRules, template, job_id)
+        # With the stack the template updates, only the resources it adds or modifies are evaluated
+        stack_baseline = None
+        if 'stack' in params:
+            stack_baseline = get_stack_baseline(params['stack'], params.get('changeSet'))
+
+        if isinstance(template_file, list) or any(c in template_file for c in '*?['):
+            if stack_baseline is not None:
+                raise Exception('A stack can only be compared with a single template file')
+            # Validate every matching template, read from the artifact in one go
+            template = get_templates(s3, input_artifact_data, template_file)
+            risk, failedRules, _ = evaluate_templates(rules, template, get_verdict_cache(), fail_fast)
+            s3_next_step(output_bucket, risk, failedRules, template, job_id, get_output_encryption(params), output_layout)
+        else:
+            # Get the JSON template file out of the artifact
+            with open_artifact(s3, input_artifact_data) as artifact_zip:
+                template_size = artifact_zip.getinfo(template_file).file_size
+                print("Template: " + template_file + " (" + str(template_size) + " bytes)")
+                if template_size > STREAMING_THRESHOLD:
+                    # Too large to hold parsed in memory, evaluate it as it is decompressed
+                    template = lambda: artifact_zip.open(template_file)
+                    with template() as template_stream:
+                        risk, failedRules = evaluate_template(rules, template_stream, get_verdict_cache(), fail_fast, stack_baseline)
+                else:
+                    template = artifact_zip.read(template_file)
+                    # Validate template from risk perspective. FailedRules can be used if you wish to expand the script to report failed items
+                    risk, failedRules = evaluate_template(rules, template, get_verdict_cache(), fail_fast, stack_baseline)
+
+                # Based on risk, store the template in the correct S3 bucket for future process
+                s3_next_step(output_bucket, risk, failedRules, template, job_id, get_output_encryption(params), output_layout)
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
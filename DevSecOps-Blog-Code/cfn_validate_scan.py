@@ -0,0 +1,134 @@
+"""Offline batch scanner for the cfn_validate_lambda rules
+
+Scores every CloudFormation template in a directory or tarball with the same
+rule engine the pipeline uses, without a CodePipeline event. Rules come from
+a local export of the rules table, for example:
+
+    aws dynamodb scan --table-name lab3DDBRules > rules.json
+    python cfn_validate_scan.py --rules rules.json templates/ > results.jsonl
+
+Templates are evaluated on a pool of processes and one JSON line is written
+per template with its path, risk, failed rules and evaluation time.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import fnmatch
+import tarfile
+import argparse
+import multiprocessing
+
+import cfn_validate_lambda
+
+_rule_set = None
+
+
+def load_rule_export(path):
+    """Loads rules from a JSON export of the rules table
+
+    Args:
+        path: A file holding the output of "aws dynamodb scan", or a JSON list of rule items
+
+    Returns:
+        The rules dictionary
+
+    Raises:
+        Exception: If the export holds no rules
+
+    """
+    with open(path) as exportFile:
+        export = json.load(exportFile)
+    items = export['Items'] if isinstance(export, dict) else export
+    rules = cfn_validate_lambda.rules_from_items(items)
+    if rules is None:
+        raise Exception('No rules found in "{0}"'.format(path))
+    return rules
+
+
+def iter_templates(source, pattern):
+    """Lists the templates in a directory or tarball
+
+    Args:
+        source: A directory or a tar file, optionally compressed
+        pattern: A glob that template file names must match
+
+    Yields:
+        (path, template) tuples. For directories the template is None and is
+        read by the worker, so file contents don't pass through this process.
+
+    """
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if fnmatch.fnmatch(name, pattern):
+                    yield os.path.join(root, name), None
+    else:
+        with tarfile.open(source) as tar:
+            for member in tar:
+                if member.isfile() and fnmatch.fnmatch(os.path.basename(member.name), pattern):
+                    yield member.name, tar.extractfile(member).read()
+
+
+def init_worker(rules):
+    """Silences evaluation logging and compiles the rule set once per worker process"""
+    global _rule_set
+    sys.stdout = open(os.devnull, 'w')
+    _rule_set = cfn_validate_lambda.compile_rules(rules)
+
+
+def scan_template(item):
+    """Evaluates one template
+
+    Args:
+        item: A (path, template) tuple from iter_templates()
+
+    Returns:
+        The result dictionary for the template
+
+    """
+    path, template = item
+    start = time.time()
+    try:
+        if template is None:
+            with open(path, 'rb') as templateFile:
+                template = templateFile.read()
+        risk, failedRules = cfn_validate_lambda.evaluate_template(_rule_set, template)
+        result = {'path': path, 'risk': risk, 'failedRules': failedRules}
+    except Exception as e:
+        result = {'path': path, 'error': str(e)}
+    result['seconds'] = round(time.time() - start, 6)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score CloudFormation templates with the cfn_validate_lambda rules")
+    parser.add_argument('source', help="Directory or tarball of templates")
+    parser.add_argument('--rules', required=True, help="JSON export of the rules table")
+    parser.add_argument('--pattern', default='*.json', help="Glob for template file names (default: *.json)")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Worker processes")
+    parser.add_argument('--chunksize', type=int, default=16, help="Templates handed to a worker at a time")
+    args = parser.parse_args(argv)
+
+    rules = load_rule_export(args.rules)
+    # Rejected rules are logged once, to stderr, as stdout only holds results
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        cfn_validate_lambda.compile_rules(rules)
+    finally:
+        sys.stdout = stdout
+    pool = multiprocessing.Pool(args.workers, init_worker, (rules,))
+    try:
+        for result in pool.imap_unordered(scan_template, iter_templates(args.source, args.pattern), args.chunksize):
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
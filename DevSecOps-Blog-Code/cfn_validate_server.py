@@ -0,0 +1,441 @@
+"""Long-running validation server for the cfn_validate_lambda rules
+
+Serves template validations over HTTP for many tenants from one process, for
+running in a container next to the pipelines. Each tenant's rules are loaded
+and compiled once and kept in memory, so a validation only pays for the
+evaluation itself:
+
+    python cfn_validate_server.py --tenants tenants.json --port 8080
+    curl --data-binary @template.json http://localhost:8080/tenants/team-a/validate
+
+The tenants file maps tenant names to their rules, either a DynamoDB rules
+table or a JSON export of one:
+
+    {"team-a": {"table": "lab3DDBRules"}, "team-b": {"rules": "rules.json"}}
+
+Rules from a table are checked against the stored rule-set version every
+RULES_CACHE_TTL seconds, like in the Lambda function. Adding ?mode=fail-fast
+to the URL stops evaluating once the template is known to fail. The response
+is a JSON object with the risk, the failed rules and the result, which is
+valid, flagged or failed as in the pipeline.
+
+Templates are evaluated in WORKERS worker processes, each with every tenant's
+rules compiled. An evaluation that runs past REQUEST_TIMEOUT seconds fails
+and its worker is replaced, so one slow template can't stall the others.
+Bodies larger than MAX_BODY_SIZE are rejected.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    import queue
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    import Queue as queue
+
+import cfn_validate_lambda
+import cfn_validate_scan
+
+# Worker processes evaluating templates
+WORKERS = multiprocessing.cpu_count()
+# Seconds an evaluation may take before its worker is killed and the template fails
+REQUEST_TIMEOUT = 10.0
+# The largest template accepted, the CloudFormation limit for templates in S3
+MAX_BODY_SIZE = 1024 * 1024
+# Workers are started fresh rather than forked from the threaded server where possible
+_process_context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+
+class TenantRules(object):
+    """The compiled rule set of one tenant, loaded on first use
+
+    Args:
+        table: The DynamoDB rules table of the tenant
+        export: A JSON export of the rules table, used instead of a table
+
+    """
+    def __init__(self, table=None, export=None):
+        if not table and not export:
+            raise Exception('A tenant needs a rules "table" or a "rules" export')
+        self.table = table
+        self.export = export
+        self.ruleSet = None
+        self.storedVersion = None
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def rule_set(self):
+        """Gets the compiled rule set, reloading it when the table has a new version"""
+        with self.lock:
+            now = time.time()
+            if self.ruleSet is not None and (self.export or now - self.loaded < cfn_validate_lambda.RULES_CACHE_TTL):
+                return self.ruleSet
+            if self.ruleSet is None or self.storedVersion is None or \
+                    cfn_validate_lambda.get_rule_set_version(self.table) != self.storedVersion:
+                if self.export:
+                    rules = cfn_validate_scan.load_rule_export(self.export)
+                else:
+                    rules = cfn_validate_lambda.load_rules(self.table)
+                    if rules is None:
+                        raise Exception('No rules found in table "{0}"'.format(self.table))
+                self.ruleSet = cfn_validate_lambda.RuleSet(rules, rules['version'])
+                self.storedVersion = rules['storedVersion']
+                print("Loaded rule set " + self.ruleSet.version, file=sys.stderr)
+            self.loaded = now
+            return self.ruleSet
+
+
+class TenantVerdictCache(object):
+    """Prefixes the keys of a shared verdict cache with the tenant name
+
+    Keeps the verdicts of each tenant apart, even when tenants share one
+    cache table.
+
+    Args:
+        cache: The shared verdict cache
+        tenant: The tenant name
+
+    """
+    def __init__(self, cache, tenant):
+        self.cache = cache
+        self.prefix = "tenant:" + tenant + ":"
+
+    def get_many(self, keys):
+        found = self.cache.get_many([self.prefix + key for key in keys])
+        return dict((key[len(self.prefix):], verdict) for key, verdict in found.items())
+
+    def put_many(self, verdicts):
+        self.cache.put_many(dict((self.prefix + key, verdict) for key, verdict in verdicts.items()))
+
+
+def read_tenants(path):
+    """Reads the tenants file
+
+    Args:
+        path: A JSON file mapping tenant names to {"table": ...} or {"rules": ...}
+
+    Returns:
+        The dictionary of tenant name to tenant definition
+
+    """
+    with open(path) as tenantsFile:
+        return json.load(tenantsFile)
+
+
+def load_tenants(tenants):
+    """Creates the TenantRules of every tenant
+
+    Args:
+        tenants: A dictionary of tenant name to {"table": ...} or {"rules": ...}
+
+    Returns:
+        A dictionary of tenant name to TenantRules
+
+    """
+    return dict((name, TenantRules(tenant.get('table'), tenant.get('rules'))) for name, tenant in tenants.items())
+
+
+def worker_main(tenants, connection, cache, verbose):
+    """Evaluates the templates sent by the server on a connection, one at a time
+
+    Runs in its own process, so a slow evaluation can be killed without
+    stopping the server, and regex rules run on the main thread, where
+    RULE_TIME_BUDGET is enforced.
+
+    Args:
+        tenants: A dictionary of tenant name to tenant definition
+        connection: The worker's end of the Pipe to the server
+        cache: Whether to cache verdicts, with get_verdict_cache()
+        verbose: Whether to log every matched rule
+
+    """
+    try:
+        tenantRules = load_tenants(tenants)
+        # Rules are compiled at start-up so the first request of a tenant isn't slower
+        for name, tenant in sorted(tenantRules.items()):
+            tenant.rule_set()
+    except Exception as e:
+        connection.send(('error', str(e)))
+        return
+    caches = {}
+    if cache:
+        caches = dict((name, TenantVerdictCache(cfn_validate_lambda.get_verdict_cache(), name)) for name in tenants)
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    connection.send(('ready', None))
+    while True:
+        try:
+            name, template, failFast = connection.recv()
+        except EOFError:
+            return
+        try:
+            risk, failedRules = cfn_validate_lambda.evaluate_template(
+                tenantRules[name].rule_set(), template, caches.get(name), failFast)
+            connection.send(('ok', (risk, failedRules)))
+        except (ValueError, KeyError) as e:
+            connection.send(('invalid', str(e)))
+        except Exception as e:
+            connection.send(('error', str(e)))
+
+
+class EvaluationTimeout(Exception):
+    """Raised when a worker doesn't finish an evaluation in time"""
+
+
+class EvaluationWorker(object):
+    """A worker process evaluating templates, replaced when it runs past the timeout
+
+    Args:
+        tenants: A dictionary of tenant name to tenant definition
+        cache: Whether the worker caches verdicts
+        verbose: Whether the worker logs every matched rule
+
+    """
+    def __init__(self, tenants, cache=True, verbose=False):
+        self.args = (tenants, cache, verbose)
+        self.process = None
+        self.connection = None
+        self.start()
+
+    def start(self):
+        """Starts the worker process and waits until its rules are compiled"""
+        connection, workerConnection = multiprocessing.Pipe()
+        self.process = _process_context.Process(
+            target=worker_main, args=(self.args[0], workerConnection) + self.args[1:])
+        self.process.daemon = True
+        self.process.start()
+        workerConnection.close()
+        self.connection = connection
+        status, message = self.receive()
+        if status != 'ready':
+            self.stop()
+            raise Exception('Worker failed to start: ' + str(message))
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+    def receive(self):
+        try:
+            return self.connection.recv()
+        except EOFError:
+            return 'error', 'worker exited'
+
+    def evaluate(self, tenant, template, failFast, timeout):
+        """Evaluates a template, restarting the worker if it doesn't finish in time
+
+        Returns:
+            The status, 'ok', 'invalid' or 'error', and the (risk, failedRules)
+            tuple or the error message
+
+        Raises:
+            EvaluationTimeout: If the evaluation took longer than timeout seconds
+
+        """
+        self.connection.send((tenant, template, failFast))
+        if not self.connection.poll(timeout):
+            self.stop()
+            self.start()
+            raise EvaluationTimeout('Evaluation took longer than {0} seconds'.format(timeout))
+        status, result = self.receive()
+        if not self.process.is_alive():
+            self.stop()
+            self.start()
+        return status, result
+
+
+class WorkerPool(object):
+    """Hands requests to idle worker processes
+
+    Args:
+        tenants: A dictionary of tenant name to tenant definition
+        workers: The number of worker processes
+        cache: Whether the workers cache verdicts
+        verbose: Whether the workers log every matched rule
+
+    """
+    def __init__(self, tenants, workers, cache=True, verbose=False):
+        self.workers = [EvaluationWorker(tenants, cache, verbose) for _ in range(max(1, workers))]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def evaluate(self, tenant, template, failFast, timeout):
+        """Evaluates a template on the next idle worker, see EvaluationWorker.evaluate()"""
+        worker = self.idle.get()
+        try:
+            return worker.evaluate(tenant, template, failFast, timeout)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+class LimitedReader(object):
+    """Reads at most size bytes from a request body"""
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def validation_result(risk):
+    if risk < cfn_validate_lambda.FLAGGED_THRESHOLD:
+        return 'valid'
+    if risk < cfn_validate_lambda.FAILURE_THRESHOLD:
+        return 'flagged'
+    return 'failed'
+
+
+class ValidationHandler(BaseHTTPRequestHandler):
+    """Handles POST /tenants/<tenant>/validate with the template as the body"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, {'status': 'ok', 'tenants': sorted(self.server.tenants)})
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = LimitedReader(self.rfile, length)
+        try:
+            if len(parts) != 3 or parts[0] != 'tenants' or parts[2] != 'validate':
+                self.send_json(404, {'error': 'Not found'})
+                return
+            if parts[1] not in self.server.tenants:
+                self.send_json(404, {'error': 'Unknown tenant "{0}"'.format(parts[1])})
+                return
+            if length > self.server.maxBodySize:
+                # The body isn't read, so the connection can't be reused
+                self.close_connection = True
+                self.send_json(413, {'error': 'Template larger than {0} bytes'.format(self.server.maxBodySize)})
+                return
+            failFast = parse_qs(url.query).get('mode', ["full"])[0] == "fail-fast"
+            start = time.time()
+            try:
+                status, result = self.server.pool.evaluate(parts[1], body.read(), failFast, self.server.timeout)
+            except EvaluationTimeout as e:
+                # A template that couldn't be checked in time fails, like a rule timeout in the Lambda function
+                self.send_json(504, {'error': str(e), 'result': 'failed'})
+                return
+            if status == 'invalid':
+                self.send_json(400, {'error': 'Invalid template: ' + result})
+                return
+            if status != 'ok':
+                self.send_json(500, {'error': result})
+                return
+            risk, failedRules = result
+            self.send_json(200, {
+                'tenant': parts[1],
+                'risk': risk,
+                'failedRules': failedRules,
+                'result': validation_result(risk),
+                'seconds': round(time.time() - start, 6)
+            })
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+        finally:
+            # Drain what wasn't read so the connection can be reused
+            if not self.close_connection:
+                while body.read(cfn_validate_lambda.STREAMING_CHUNK):
+                    pass
+
+    def send_json(self, status, document):
+        data = json.dumps(document, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s - %s\n" % (self.address_string(), format % args))
+
+
+class ValidationServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handing each request to a pool of worker processes
+
+    Args:
+        address: The (host, port) to listen on
+        tenants: A dictionary of tenant name to {"table": ...} or {"rules": ...}
+        workers: The number of worker processes, WORKERS by default
+        timeout: The seconds an evaluation may take, REQUEST_TIMEOUT by default
+        maxBodySize: The largest template accepted, in bytes, MAX_BODY_SIZE by default
+        cache: Whether to cache verdicts, with the keys of each tenant kept
+            apart by a TenantVerdictCache
+        verbose: Whether to log every matched rule
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, tenants, workers=None, timeout=None, maxBodySize=None, cache=True, verbose=False):
+        self.tenants = tenants
+        self.timeout = timeout or REQUEST_TIMEOUT
+        self.maxBodySize = maxBodySize or MAX_BODY_SIZE
+        # Workers are started before the server socket, so a tenant that fails to load stops start-up
+        self.pool = WorkerPool(tenants, workers or WORKERS, cache, verbose)
+        HTTPServer.__init__(self, address, ValidationHandler)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve cfn_validate_lambda validations over HTTP")
+    parser.add_argument('--tenants', required=True, help="JSON file mapping tenants to their rules")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on (default: 8080)")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="Worker processes evaluating templates (default: {0})".format(WORKERS))
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT,
+                        help="Seconds an evaluation may take before it fails (default: {0})".format(REQUEST_TIMEOUT))
+    parser.add_argument('--max-body-size', type=int, default=MAX_BODY_SIZE,
+                        help="Largest template accepted, in bytes (default: {0})".format(MAX_BODY_SIZE))
+    parser.add_argument('--verbose', action='store_true', help="Log every matched rule, as the Lambda function does")
+    args = parser.parse_args(argv)
+
+    tenants = read_tenants(args.tenants)
+    server = ValidationServer((args.host, args.port), tenants, args.workers, args.timeout, args.max_body_size,
+                              verbose=args.verbose)
+    print("Serving {0} tenants on {1}:{2} with {3} workers".format(len(tenants), args.host, args.port, args.workers),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
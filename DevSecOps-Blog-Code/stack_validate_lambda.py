@@ -9,6 +9,7 @@ Attributes:
 """
 
 from __future__ import print_function
+import os
 import json
 import csv
 import time
@@ -20,12 +21,41 @@ import boto3
 import botocore
 import traceback
 import zipfile
+import threading
+import bisect
+import zlib
+import base64
+from cfn_validate_lambda import map_concurrently, parse_cidr
 
 # Would you like to print the results as JSON to output?
 SCRIPT_OUTPUT_JSON = True
 code_pipeline = boto3.client('codepipeline')
-EC2_CLIENT = boto3.client('ec2')
 cf = boto3.client('cloudformation')
+# Seconds a warm container keeps using the region list
+REGIONS_CACHE_TTL = int(os.environ.get('REGIONS_CACHE_TTL', '3600'))
+# The region list of a warm container
+_regions_cache = {'regions': None, 'loaded': 0}
+# Regions checked at the same time
+REGION_WORKERS = int(os.environ.get('REGION_WORKERS', '8'))
+# Seconds kept back from the Lambda timeout to report the results
+DEADLINE_MARGIN = 5
+# The longest continuation token CodePipeline accepts
+CONTINUATION_TOKEN_LIMIT = 2048
+# Security group IDs per describe_security_groups call
+GROUP_ID_BATCH = 200
+# Controls run on the stack, from the registered ones
+ENABLED_CONTROLS = [c.strip() for c in os.environ.get('CONTROLS', '4.1').split(',') if c.strip()]
+# The registered controls, in the order they are reported
+CONTROLS = []
+# Source CIDRs allowed to reach restricted ports, IPv4 or IPv6, comma separated
+ALLOWED_CIDRS = os.environ.get('ALLOWED_CIDRS', '72.21.196.67/32')
+# Optional file with more allowed CIDRs, one per line, packaged with the function
+ALLOWLIST_FILE = os.environ.get('ALLOWLIST_FILE')
+# The CidrIndex of the allowed CIDRs, built on first use
+_allowlist = None
+# Clients by service and region, created once per container
+_clients = {}
+_clients_lock = threading.Lock()
 
 
 def put_job_success(job, message):
@@ -60,7 +90,47 @@ def put_job_failure(job, message):
     code_pipeline.put_job_failure_result(jobId=job, failureDetails={'message': message, 'type': 'JobFailed'})
 
 
-def continue_job_later(job, message):
+def build_continuation_token(job, checkpoint=None):
+    """Builds the continuation token of a job
+
+    Args:
+        job: The JobID
+        checkpoint: Optional progress to resume from, stored compressed
+
+    Returns:
+        The continuation token
+
+    """
+    token = {'previous_job_id': job}
+    if checkpoint is not None:
+        data = zlib.compress(json.dumps(checkpoint, sort_keys=True, separators=(',', ':')).encode('utf-8'), 9)
+        token['checkpoint'] = base64.b64encode(data).decode('ascii')
+    return json.dumps(token)
+
+
+def read_checkpoint(job_data):
+    """Reads the checkpoint from the continuation token of a continued job
+
+    Args:
+        job_data: The job data structure
+
+    Returns:
+        The checkpoint, or None if the job is not a continuation or has no checkpoint
+
+    """
+    if 'continuationToken' not in job_data:
+        return None
+    try:
+        token = json.loads(job_data['continuationToken'])
+        if 'checkpoint' not in token:
+            return None
+        return json.loads(zlib.decompress(base64.b64decode(token['checkpoint'])).decode('utf-8'))
+    except (ValueError, TypeError, zlib.error) as e:
+        print("Ignoring unreadable continuation token: " + str(e))
+        return None
+
+
+def continue_job_later(job, message, checkpoint=None):
     """Notify CodePipeline of a continuing job
 
     This will cause CodePipeline to invoke the function again with the
@@ -69,7 +139,7 @@ def continue_job_later(job, message):
     Args:
         job: The JobID
         message: A message to be logged relating to the job status
-        continuation_token: The continuation token
+        checkpoint: Optional progress to resume from, see build_continuation_token()
 
     Raises:
         Exception: Any exception thrown by .put_job_success_result()
@@ -78,7 +148,7 @@ def continue_job_later(job, message):
 
     # Use the continuation token to keep track of any job execution state
     # This data will be available when a new job is scheduled to continue the current execution
-    continuation_token = json.dumps({'previous_job_id': job})
+    continuation_token = build_continuation_token(job, checkpoint)
 
     print('Putting job continuation')
     print(message)
@@ -121,45 +191,464 @@ def delete_stack(stack):
     cf.delete_stack(StackName=stack)
 
 
+def get_client(service, region):
+    """Gets the client of a service in a region, creating it on first use
+
+    boto3 clients are thread-safe once created, but creating them is not, so
+    creation is serialized.
+
+    """
+    with _clients_lock:
+        if (service, region) not in _clients:
+            _clients[(service, region)] = boto3.client(service, region_name=region)
+        return _clients[(service, region)]
+
+
+def get_deadline(context, margin=None):
+    """Gets the time by which region checks have to finish
+
+    Args:
+        context: The context passed by Lambda, or None when run outside Lambda
+        margin: Seconds kept back from the timeout, DEADLINE_MARGIN by default
+
+    Returns:
+        The deadline as a time.time() value, or None for no deadline
+
+    """
+    if context is None:
+        return None
+    margin = DEADLINE_MARGIN if margin is None else margin
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - margin
+
+
+def map_regions(function, regions, deadline=None, workers=None):
+    """Applies function to every region with map_concurrently
+
+    Args:
+        function: The function to apply to a region name
+        regions: The list of region names
+        deadline: An optional time.time() value to stop at
+        workers: The maximum number of threads, REGION_WORKERS by default
+
+    Returns:
+        A dictionary of region to result, and the list of regions that
+        were not checked before the deadline, in the order of regions
+
+    Raises:
+        Exception: The first exception raised by function
+
+    """
+    results = {}
+
+    def check(region):
+        results[region] = function(region)
+
+    map_concurrently(check, regions, workers or REGION_WORKERS, deadline)
+    # Abandoned regions may still finish after the deadline, so only a copy is used
+    checked = dict(results)
+    return checked, [region for region in regions if region not in checked]
+
+
 # --- Security Groups ---
-# 4.1 Ensure no security groups allow ingress from 0.0.0.0/0 to port 22 (Scored)
-def control_4_1_ensure_ssh_not_open_to_world(regions, stackName):
-    """Summary
+def stack_security_group_ids(stackName):
+    """Lists the security groups of a stack and of its nested stacks
+
+    Args:
+        stackName: The name or ID of the stack
 
     Returns:
-        TYPE: Description
+        A dictionary of region to the physical IDs of the security groups,
+        or None if the stack doesn't exist in the region of the function
+
+    Raises:
+        Any exceptions raised by .describe_stacks() besides that the stack
+        doesn't exist, or by .list_stack_resources()
+
+    """
+    try:
+        stackId = cf.describe_stacks(StackName=stackName)['Stacks'][0]['StackId']
+    except botocore.exceptions.ClientError as e:
+        if "does not exist" in e.response['Error']['Message']:
+            return None
+        raise e
+    groupIds = {}
+    stacks = [stackId]
+    while stacks:
+        stackId = stacks.pop()
+        # arn:aws:cloudformation:<region>:<account>:stack/<name>/<id>
+        region = stackId.split(':')[3]
+        paginator = get_client('cloudformation', region).get_paginator('list_stack_resources')
+        for page in paginator.paginate(StackName=stackId):
+            for resource in page['StackResourceSummaries']:
+                physicalId = resource.get('PhysicalResourceId')
+                if not physicalId or resource['ResourceStatus'] == 'DELETE_COMPLETE':
+                    continue
+                if resource['ResourceType'] == 'AWS::CloudFormation::Stack':
+                    stacks.append(physicalId)
+                elif resource['ResourceType'] == 'AWS::EC2::SecurityGroup':
+                    groupIds.setdefault(region, []).append(physicalId)
+    return groupIds
+
+
+def describe_security_groups_by_id(region, groupIds):
+    """Describes security groups by their physical IDs
+
+    Args:
+        region: The region of the security groups
+        groupIds: Group IDs, or group names for groups outside of a VPC
+
+    Returns:
+        The security groups
+
+    """
+    paginator = get_client('ec2', region).get_paginator('describe_security_groups')
+    ids = [groupId for groupId in groupIds if groupId.startswith('sg-')]
+    names = [groupId for groupId in groupIds if not groupId.startswith('sg-')]
+    groups = []
+    # Page sizes can't be set together with GroupIds, so the IDs are batched instead
+    for n in range(0, len(ids), GROUP_ID_BATCH):
+        for page in paginator.paginate(GroupIds=ids[n:n + GROUP_ID_BATCH]):
+            groups.extend(page['SecurityGroups'])
+    if names:
+        for page in paginator.paginate(GroupNames=names):
+            groups.extend(page['SecurityGroups'])
+    return groups
+
+
+def describe_security_groups_by_tag(region, stackName):
+    """Describes the security groups tagged with the stack name
+
+    Args:
+        region: The region to search
+        stackName: The name of the stack
+
+    Returns:
+        The security groups
+
+    """
+    paginator = get_client('ec2', region).get_paginator('describe_security_groups')
+    groups = []
+    for page in paginator.paginate(Filters=[{'Name': 'tag:aws:cloudformation:stack-name', 'Values': [stackName]}]):
+        groups.extend(page['SecurityGroups'])
+    return groups
+
+
+def fetch_security_groups(snapshot):
+    """Describes the security groups of the stack in the region of the snapshot"""
+    if snapshot.groupIds is None:
+        return describe_security_groups_by_tag(snapshot.region, snapshot.stackName)
+    return describe_security_groups_by_id(snapshot.region, snapshot.groupIds)
+
+
+def fetch_default_security_groups(snapshot):
+    """Describes the default security groups of the VPCs the stack's security groups are in"""
+    vpcIds = sorted(set(m['VpcId'] for m in snapshot.get('securityGroups') if m.get('VpcId')))
+    if not vpcIds:
+        return []
+    paginator = get_client('ec2', snapshot.region).get_paginator('describe_security_groups')
+    groups = []
+    for page in paginator.paginate(Filters=[{'Name': 'group-name', 'Values': ['default']},
+                                            {'Name': 'vpc-id', 'Values': vpcIds}]):
+        groups.extend(page['SecurityGroups'])
+    return groups
+
+
+# The describe data a snapshot can hold, by the name controls declare it with
+SNAPSHOT_DATA = {
+    'securityGroups': fetch_security_groups,
+    'defaultSecurityGroups': fetch_default_security_groups
+}
+
+
+class RegionSnapshot(object):
+    """The describe data of one region, fetched once and shared by every control
+
+    Args:
+        region: The region
+        stackName: The stack being validated
+        groupIds: The IDs of the stack's security groups in the region, or
+            None to find them by the stack name tag
+
+    """
+    def __init__(self, region, stackName, groupIds=None):
+        self.region = region
+        self.stackName = stackName
+        self.groupIds = groupIds
+        self.data = {}
+
+    def get(self, name):
+        """Gets describe data, fetching it on first use"""
+        if name not in self.data:
+            self.data[name] = SNAPSHOT_DATA[name](self)
+        return self.data[name]
+
+
+def register_control(controlId, description, failReason, needs, scored=True):
+    """Registers a control function
+
+    A control function takes a region and its RegionSnapshot, and returns
+    the offenders found in the region.
+
+    Args:
+        controlId: The CIS benchmark ID, such as "4.1"
+        description: What the control checks
+        failReason: The reason reported when there are offenders
+        needs: The names of the SNAPSHOT_DATA the control reads
+        scored: Whether the control is scored
+
+    """
+    def register(function):
+        CONTROLS.append({'ControlId': controlId, 'Description': description, 'failReason': failReason,
+                         'needs': needs, 'ScoredControl': scored, 'function': function})
+        return function
+    return register
+
+
+class CidrIndex(object):
+    """Sorted, merged address intervals answering CIDR containment with a binary search
+
+    Args:
+        cidrs: The CIDR strings to index
+
+    Raises:
+        Exception: If a CIDR can't be parsed
+
+    """
+    def __init__(self, cidrs):
+        ranges = {}
+        for cidr in cidrs:
+            parsed = parse_cidr(cidr)
+            if parsed is None:
+                raise Exception('Invalid CIDR in allowlist: "{0}"'.format(cidr))
+            ranges.setdefault(parsed[0], []).append(parsed[1:])
+        self.starts = {}
+        self.ends = {}
+        for family, intervals in ranges.items():
+            starts = []
+            ends = []
+            # Overlapping and adjacent ranges are merged, so a CIDR is allowed
+            # if and only if it falls within a single interval
+            for first, last in sorted(intervals):
+                if ends and first <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], last)
+                else:
+                    starts.append(first)
+                    ends.append(last)
+            self.starts[family] = starts
+            self.ends[family] = ends
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+    def contains(self, cidr):
+        """Checks whether every address of a CIDR is within the indexed ranges"""
+        parsed = parse_cidr(cidr)
+        if parsed is None:
+            return False
+        family, first, last = parsed
+        starts = self.starts.get(family, [])
+        index = bisect.bisect_right(starts, first) - 1
+        return index >= 0 and last <= self.ends[family][index]
+
+
+def get_allowlist():
+    """Gets the index of the allowed CIDRs, built once per container
+
+    Returns:
+        The CidrIndex of ALLOWED_CIDRS and the CIDRs in ALLOWLIST_FILE
+
     """
-    result = True
-    failReason = ""
+    global _allowlist
+    if _allowlist is None:
+        cidrs = [cidr for cidr in ALLOWED_CIDRS.split(',') if cidr.strip()]
+        if ALLOWLIST_FILE:
+            with open(ALLOWLIST_FILE) as allowlistFile:
+                for line in allowlistFile:
+                    line = line.split('#')[0].strip()
+                    if line:
+                        cidrs.append(line)
+        _allowlist = CidrIndex(cidrs)
+        print("Allowlist: " + str(len(_allowlist)) + " ranges")
+    return _allowlist
+
+
+def permission_sources(permission):
+    """Lists the IPv4 and IPv6 source CIDRs of an ingress permission"""
+    return [r['CidrIp'] for r in permission.get('IpRanges', [])] + \
+        [r['CidrIpv6'] for r in permission.get('Ipv6Ranges', [])]
+
+
+def permission_covers_port(permission, port):
+    """Checks whether an ingress permission opens a TCP or UDP port"""
+    protocol = str(permission['IpProtocol'])
+    if protocol == "-1":
+        return True
+    if protocol not in ('tcp', '6', 'udp', '17') or 'FromPort' not in permission:
+        return False
+    return int(permission['FromPort']) <= port <= int(permission['ToPort'])
+
+
+def port_offenders(region, groups, port):
+    """Lists the security groups with a port open to sources outside the allowlist
+
+    Each source CIDR of a permission opening the port has to be within the
+    allowed CIDRs. Sources that are security groups or prefix lists are not
+    checked.
+
+    Args:
+        region: The region of the security groups
+        groups: The security groups to check
+        port: The port
+
+    Returns:
+        The offenders among the groups, one per offending permission
+
+    """
+    allowlist = get_allowlist()
     offenders = []
-    control = "4.1"
-    description = "Ensure that security groups allow ingress from approved CIDR range to port 22"
-    scored = True
-    for n in regions:
-        client = boto3.client('ec2', region_name=n)
-        response = client.describe_security_groups(
-            Filters=[{'Name': 'tag:aws:cloudformation:stack-name', 'Values': [stackName]}])
-        for m in response['SecurityGroups']:
-            if "72.21.196.67/32" not in str(m['IpPermissions']):
-                for o in m['IpPermissions']:
-                    try:
-                        if int(o['FromPort']) <= 22 <= int(o['ToPort']):
-                            result = False
-                            failReason = "Found Security Group with port 22 open to the wrong source IP range"
-                            offenders.append(str(m['GroupId']))
-                    except:
-                        if str(o['IpProtocol']) == "-1":
-                            result = False
-                            failReason = "Found Security Group with port 22 open to the wrong source IP range"
-                            offenders.append(str(n) + " : " + str(m['GroupId']))
-    return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'ScoredControl': scored,
-            'Description': description, 'ControlId': control}
+    for m in groups:
+        for o in m['IpPermissions']:
+            if permission_covers_port(o, port) and \
+                    any(not allowlist.contains(cidr) for cidr in permission_sources(o)):
+                if str(o['IpProtocol']) == "-1":
+                    offenders.append(str(region) + " : " + str(m['GroupId']))
+                else:
+                    offenders.append(str(m['GroupId']))
+    return offenders
+
+
+# 4.1 Ensure no security groups allow ingress from 0.0.0.0/0 to port 22 (Scored)
+@register_control("4.1", "Ensure that security groups allow ingress from approved CIDR range to port 22",
+                  "Found Security Group with port 22 open to the wrong source IP range", ['securityGroups'])
+def control_4_1_ensure_ssh_not_open_to_world(region, snapshot):
+    return port_offenders(region, snapshot.get('securityGroups'), 22)
+
+
+# 4.2 Ensure no security groups allow ingress from 0.0.0.0/0 to port 3389 (Scored)
+@register_control("4.2", "Ensure that security groups allow ingress from approved CIDR range to port 3389",
+                  "Found Security Group with port 3389 open to the wrong source IP range", ['securityGroups'])
+def control_4_2_ensure_rdp_not_open_to_world(region, snapshot):
+    return port_offenders(region, snapshot.get('securityGroups'), 3389)
+
+
+# 4.3 Ensure the default security group of every VPC restricts all traffic (Scored)
+@register_control("4.3", "Ensure the default security group of every VPC the stack uses restricts all traffic",
+                  "Found default Security Group that allows traffic", ['defaultSecurityGroups'])
+def control_4_3_ensure_default_security_groups_restrict_traffic(region, snapshot):
+    return [str(region) + " : " + str(m['GroupId']) for m in snapshot.get('defaultSecurityGroups')
+            if m['IpPermissions'] or m['IpPermissionsEgress']]
+
+
+def enabled_controls():
+    """Gets the registered controls listed in ENABLED_CONTROLS
+
+    Returns:
+        The enabled controls, in the order they are reported
+
+    Raises:
+        Exception: If a listed control isn't registered or none is listed,
+            so a misconfigured gate fails instead of passing every stack
+
+    """
+    registered = [control['ControlId'] for control in CONTROLS]
+    unknown = [controlId for controlId in ENABLED_CONTROLS if controlId not in registered]
+    if unknown:
+        raise Exception('Unknown controls in CONTROLS: {0}, registered controls are {1}'.format(
+            ', '.join(unknown), ', '.join(registered)))
+    if not ENABLED_CONTROLS:
+        raise Exception('No controls enabled in CONTROLS')
+    return [control for control in CONTROLS if control['ControlId'] in ENABLED_CONTROLS]
+
+
+def run_controls(controls, stackName, regions=None, deadline=None, done=None, timing=None):
+    """Runs controls on the security groups of a stack
+
+    The security groups are looked up in the resources of the stack and of
+    its nested stacks. If the stack isn't found in the region of the
+    function, every region is searched for groups tagged with the stack name
+    instead.
+
+    Regions are checked concurrently. The describe data every control needs
+    is fetched once per region into a RegionSnapshot, then each control is
+    evaluated on it. Offenders are listed in the order of regions whatever
+    order the checks finish in. Regions that couldn't be checked before the
+    deadline fail the controls and are listed in Unchecked.
+
+    Regions already checked by an earlier invocation are passed in done and
+    not checked again.
+
+    Args:
+        controls: The registered controls to run
+        stackName: The stack whose security groups are checked
+        regions: The regions to search, or None to search every region
+        deadline: An optional time.time() value by which checks must finish
+        done: The offenders of each control in the regions already checked
+        timing: An optional dictionary to add the seconds spent on setup,
+            on describe calls and on evaluating the controls to
+
+    Returns:
+        The result of each control, in the order of controls, and the
+        offenders of each control in every region checked so far
+    """
+    start = time.time()
+    groupIds = stack_security_group_ids(stackName)
+    if groupIds is None:
+        print("Stack " + stackName + " not found, searching every region for its security groups")
+        regions = regions if regions is not None else get_regions()
+    else:
+        regions = sorted(groupIds)
+    needs = sorted(set(name for control in controls for name in control['needs']))
+
+    # Seconds spent fetching snapshots and evaluating controls, summed over the regions
+    regionTiming = []
+
+    def check_region(region):
+        fetchStart = time.time()
+        snapshot = RegionSnapshot(region, stackName, None if groupIds is None else groupIds[region])
+        for name in needs:
+            snapshot.get(name)
+        evaluateStart = time.time()
+        offenders = [control['function'](region, snapshot) for control in controls]
+        regionTiming.append((evaluateStart - fetchStart, time.time() - evaluateStart))
+        return offenders
+
+    done = done or {}
+    setupSeconds = time.time() - start
+    regionOffenders, unchecked = map_regions(check_region, [n for n in regions if n not in done], deadline)
+    regionOffenders.update(done)
+    if timing is not None:
+        timing['setup'] = timing.get('setup', 0) + setupSeconds
+        timing['describe'] = timing.get('describe', 0) + sum(t[0] for t in regionTiming)
+        timing['evaluation'] = timing.get('evaluation', 0) + sum(t[1] for t in regionTiming)
+    results = []
+    for index, control in enumerate(controls):
+        offenders = []
+        for n in regions:
+            if n in regionOffenders:
+                offenders.extend(regionOffenders[n][index])
+        result = True
+        failReason = ""
+        if offenders:
+            result = False
+            failReason = control['failReason']
+        elif unchecked:
+            result = False
+            failReason = "Could not check regions before the timeout: " + ", ".join(unchecked)
+        results.append({'Result': result, 'failReason': failReason, 'Offenders': offenders,
+                        'ScoredControl': control['ScoredControl'], 'Description': control['Description'],
+                        'ControlId': control['ControlId'], 'Unchecked': unchecked})
+    return results, regionOffenders
 
 
 def get_regions():
-    region_response = EC2_CLIENT.describe_regions()
-    regions = [region['RegionName'] for region in region_response['Regions']]
-    return regions
+    """Lists the regions, reusing the list of a warm container for REGIONS_CACHE_TTL seconds"""
+    now = time.time()
+    if _regions_cache['regions'] is None or now - _regions_cache['loaded'] >= REGIONS_CACHE_TTL:
+        # The client of the function's own region, created on first use
+        region_response = get_client('ec2', None).describe_regions()
+        _regions_cache['regions'] = [region['RegionName'] for region in region_response['Regions']]
+        _regions_cache['loaded'] = now
+    return _regions_cache['regions']
 
 def json_output(controlResult):
     """Summary
@@ -232,33 +721,67 @@ def lambda_handler(event, context):
     # scored : Boolean - True/False
     # Check if the script is initiade from AWS Config Rules
     # Print the entire event for tracking
+    invocationStart = time.time()
+    timing = {}
     print("Received event: " + json.dumps(event, indent=2))
     # Extract the Job ID
     job_id = event['CodePipeline.job']['id']
-    # Globally used resources
-    region_list = get_regions()
     stackName = event['CodePipeline.job']['data']['actionConfiguration']['configuration']['UserParameters']
     print("stackName: " + stackName)
 
-    # Run individual controls.
-    # Comment out unwanted controls
-    control4 = []
-    control_4_1_result = control_4_1_ensure_ssh_not_open_to_world(region_list, stackName)
-    print('control_4_1_result: ' + str(control_4_1_result['Result']))
-    control4.append(control_4_1_result)
-
-    # Join results
+    # Run the enabled controls, set in the CONTROLS environment variable.
+    # Regions are only listed if the stack has to be searched for in every region
+    try:
+        enabled = enabled_controls()
+    except Exception as e:
+        put_job_failure(job_id, 'Function exception: ' + str(e))
+        return
+    controlIds = [c['ControlId'] for c in enabled]
+    # A continued job resumes from the regions checked by the previous invocations
+    checkpoint = read_checkpoint(event['CodePipeline.job']['data'])
+    if checkpoint is None or checkpoint.get('stack') != stackName or checkpoint.get('controls') != controlIds:
+        checkpoint = {'stack': stackName, 'controls': controlIds, 'done': {}}
+    results, done = run_controls(enabled, stackName, None, get_deadline(context), checkpoint['done'], timing)
+    # Describe and evaluation times are summed over regions checked concurrently
+    print("Timing: setup {0:.3f}s, describe {1:.3f}s, evaluation {2:.3f}s, elapsed {3:.3f}s".format(
+        timing['setup'], timing['describe'], timing['evaluation'], time.time() - invocationStart))
+    unchecked = results[0]['Unchecked'] if results else []
+    if unchecked and len(done) > len(checkpoint['done']):
+        # Some regions were checked, continue with the others in a new invocation
+        checkpoint['done'] = done
+        if len(build_continuation_token(job_id, checkpoint)) <= CONTINUATION_TOKEN_LIMIT:
+            continue_job_later(job_id, 'Checked ' + str(len(done)) + ' regions, ' +
+                               str(len(unchecked)) + ' left: ' + ', '.join(unchecked), checkpoint)
+            return
+        print("Too many offenders to checkpoint, reporting without the unchecked regions")
+    for result in results:
+        print('control_' + result['ControlId'].replace('.', '_') + '_result: ' + str(result['Result']))
+
+    # Join results, grouped by CIS section
     controls = []
-    controls.append(control4)
+    sections = {}
+    for result in results:
+        section = result['ControlId'].split('.')[0]
+        if section not in sections:
+            sections[section] = []
+            controls.append(sections[section])
+        sections[section].append(result)
 
     # Build JSON structure for console output if enabled
-    if SCRIPT_OUTPUT_JSON:
+    if SCRIPT_OUTPUT_JSON and controls:
         json_output(controls)
-    if (control_4_1_result['Result']):
+    failed = [result for result in results if not result['Result']]
+    if not failed:
         print("\n")
         put_job_success(job_id, 'Job succesful, minimal or no risk detected.')
+    elif not any(result['Offenders'] for result in failed):
+        # Nothing was found, but not every region was checked
+        print("\n")
+        put_job_failure(job_id, 'Function exception: ' + failed[0]['failReason'])
     else:
         print("\n")
         if stack_exists(stackName):
             delete_stack(stackName)
-        put_job_failure(job_id, 'Function exception: Found Security group SSH violation and deleted the stack. Check the logs ')
\ No newline at end of file
+        put_job_failure(job_id, 'Function exception: Found Security group violations in controls ' +
+                        ', '.join(result['ControlId'] for result in failed if result['Offenders']) +
+                        ' and deleted the stack. Check the logs ')
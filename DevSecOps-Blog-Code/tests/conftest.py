@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The Lambda modules live next to this directory. stack_validate_lambda
+# creates AWS clients on import, which needs a region but no credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,129 @@
+import io
+import json
+import random
+import re
+
+import pytest
+
+import cfn_validate_lambda
+
+
+class ChunkedReader(object):
+    """Returns at most size bytes per read, to split values at every boundary"""
+    def __init__(self, data, size):
+        self.fileobj = io.BytesIO(data)
+        self.size = size
+
+    def read(self, size=-1):
+        return self.fileobj.read(self.size)
+
+
+def stream_value(text, size):
+    return cfn_validate_lambda.TemplateStream(ChunkedReader(text.encode('utf-8'), size)).value()
+
+
+TEMPLATE = {
+    "AWSTemplateFormatVersion": "2010-09-09",
+    "Description": "Escaped \\\" quotes and {brackets} [inside] strings",
+    "Parameters": {"Cidr": {"Type": "String", "Default": "0.0.0.0/0"}},
+    "Resources": {
+        "SG": {
+            "Type": "AWS::EC2::SecurityGroup",
+            "Properties": {
+                "SecurityGroupIngress": [
+                    {"IpProtocol": "tcp", "FromPort": 22, "ToPort": 22, "CidrIp": {"Ref": "Cidr"}}
+                ],
+                "Tags": [{"Key": "Name", "Value": u"café ☃"}]
+            }
+        },
+        "Instance": {"Type": "AWS::EC2::Instance", "Properties": {"ImageId": "ami-12345678", "Weight": -2500.5e-3}},
+        "Empty": {}
+    },
+    "Outputs": {"Id": {"Value": {"Ref": "SG"}}}
+}
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 65536])
+def test_iter_template_resources_matches_json_loads(size):
+    data = json.dumps(TEMPLATE, indent=2).encode('utf-8')
+    resources = list(cfn_validate_lambda.iter_template_resources(ChunkedReader(data, size)))
+    assert resources == list(json.loads(data.decode('utf-8'))['Resources'].items())
+
+
+def test_iter_template_resources_requires_resources():
+    with pytest.raises(KeyError):
+        list(cfn_validate_lambda.iter_template_resources(io.BytesIO(b'{"Outputs": {}}')))
+    with pytest.raises(KeyError):
+        list(cfn_validate_lambda.iter_template_resources(io.BytesIO(b'{}')))
+
+
+def test_iter_template_resources_rejects_truncated_templates():
+    with pytest.raises(ValueError):
+        list(cfn_validate_lambda.iter_template_resources(io.BytesIO(b'{"Resources": {"A": {"Type": "X"')))
+
+
+@pytest.mark.parametrize('text', ['-2500.5', '1e10', '-0.25E-3', '12345678901234567890', 'true', 'false', 'null'])
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 5, 6, 7])
+def test_stream_value_reads_scalars_split_across_reads(text, size):
+    assert stream_value(text, size) == json.loads(text)
+    assert stream_value('[' + text + ', 1]', size) == json.loads('[' + text + ', 1]')
+
+
+def test_stream_value_fuzz():
+    generator = random.Random(1234)
+
+    def random_value(depth):
+        kind = generator.randrange(7 if depth < 3 else 4)
+        if kind == 0:
+            return generator.randint(-10 ** 6, 10 ** 6)
+        if kind == 1:
+            return round(generator.uniform(-1e4, 1e4), generator.randrange(6))
+        if kind == 2:
+            return ''.join(generator.choice(u'ab"\\{}[] é') for _ in range(generator.randrange(6)))
+        if kind == 3:
+            return generator.choice([True, False, None])
+        if kind in (4, 5):
+            return [random_value(depth + 1) for _ in range(generator.randrange(4))]
+        return dict((str(n), random_value(depth + 1)) for n in range(generator.randrange(4)))
+
+    for _ in range(500):
+        text = json.dumps(random_value(0))
+        assert stream_value(text, generator.randint(1, 7)) == json.loads(text), text
+
+
+def test_skip_value_skips_nested_values():
+    stream = cfn_validate_lambda.TemplateStream(ChunkedReader(b'[{"a": "}\\"]"}, [1, [2]]], 3', 2))
+    stream.skip_value()
+    assert stream.next_is(u',')
+    assert stream.value() == 3
+
+
+def required_literals(pattern):
+    return cfn_validate_lambda.required_literals(re.compile(pattern))
+
+
+def test_required_literals_collects_mandatory_literals():
+    assert required_literals(r'^.*Ingress.*((0\.){3}0\/0)') == ['0/0', 'Ingress']
+
+
+def test_required_literals_skips_optional_parts():
+    assert required_literals(r'^.*Ingress(Rule)?.*(abc|def)') == ['Ingress']
+    assert required_literals(r'^.*Ingress(Rule)*') == ['Ingress']
+    assert required_literals(r'^.*Ingress(Rule)+') == ['Ingress', 'Rule']
+
+
+def test_required_literals_skips_case_insensitive_parts():
+    assert required_literals(r'(?i)^.*Ingress') == []
+    assert required_literals(r'^.*(?i:FromPort).*CidrIp') == ['CidrIp']
+
+
+def test_required_literals_fuzz_has_no_false_negatives():
+    generator = random.Random(1234)
+    patterns = [r'^.*(?i:ABC)def', r'^.*Ingress.*(?i:cidrip).*0/0', r'^.*abc(de)?f.*xyz']
+    for pattern in patterns:
+        compiled = re.compile(pattern)
+        literals = cfn_validate_lambda.required_literals(compiled)
+        for _ in range(5000):
+            text = ''.join(generator.choice('abcdefxyzABCDEFXYZ Ingres0/') for _ in range(generator.randint(0, 20)))
+            if compiled.match(text):
+                assert all(literal in text for literal in literals), (pattern, text)
@@ -0,0 +1,65 @@
+import json
+import random
+
+import pytest
+
+import stack_validate_lambda
+
+
+def test_cidr_index_contains():
+    index = stack_validate_lambda.CidrIndex(['10.0.0.0/16', '10.1.0.0/16', '192.168.1.7/32', '2001:db8::/32'])
+    # Adjacent ranges are merged
+    assert len(index) == 3
+    assert index.contains('10.0.0.0/15')
+    assert index.contains('10.1.255.255/32')
+    assert not index.contains('10.0.0.0/14')
+    assert index.contains('192.168.1.7')
+    assert not index.contains('192.168.1.6/31')
+    assert index.contains('2001:db8:1::/48')
+    assert not index.contains('2001:db9::/48')
+    assert not index.contains('0.0.0.0/0')
+    assert not index.contains('not a cidr')
+
+
+def test_cidr_index_rejects_invalid_cidrs():
+    with pytest.raises(Exception):
+        stack_validate_lambda.CidrIndex(['10.0.0.0/33'])
+
+
+def test_cidr_index_fuzz_matches_brute_force():
+    generator = random.Random(1234)
+
+    def random_cidr():
+        # Prefixes of at most 12 bits, so every CIDR is a run of whole /12 blocks
+        address = generator.randrange(2 ** 12) << 20
+        return '{0}.{1}.{2}.{3}/{4}'.format(address >> 24, (address >> 16) & 255, (address >> 8) & 255,
+                                            address & 255, generator.randint(4, 12))
+
+    def blocks(cidr):
+        _, first, last = stack_validate_lambda.parse_cidr(cidr)
+        return set(range(first >> 20, (last >> 20) + 1))
+
+    for _ in range(100):
+        cidrs = [random_cidr() for _ in range(generator.randint(1, 20))]
+        index = stack_validate_lambda.CidrIndex(cidrs)
+        allowed = set()
+        for cidr in cidrs:
+            allowed.update(blocks(cidr))
+        for _ in range(50):
+            cidr = random_cidr()
+            assert index.contains(cidr) == blocks(cidr).issubset(allowed), (cidrs, cidr)
+
+
+def test_checkpoint_round_trip():
+    checkpoint = {'stack': 'main', 'controls': ['4.1', '4.3'],
+                  'done': {'us-east-1': {'4.1': ['sg-1']}, 'eu-west-1': {}}}
+    token = stack_validate_lambda.build_continuation_token('job-1', checkpoint)
+    assert json.loads(token)['previous_job_id'] == 'job-1'
+    assert stack_validate_lambda.read_checkpoint({'continuationToken': token}) == checkpoint
+
+
+def test_read_checkpoint_without_checkpoint():
+    assert stack_validate_lambda.read_checkpoint({}) is None
+    token = stack_validate_lambda.build_continuation_token('job-1')
+    assert stack_validate_lambda.read_checkpoint({'continuationToken': token}) is None
+    assert stack_validate_lambda.read_checkpoint({'continuationToken': '{"checkpoint": "not base64"}'}) is None
@@ -18,6 +18,11 @@ import zlib
 import logging
 import boto3
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 __email__ = 'armandl@amazon.com'
 __status__ = 'sample'
 
@@ -88,6 +93,92 @@ def eval_flow(message,instance_ip='none'):
             logging.info('Unrecognised traffic initiated from host...'+filter_result)
     return {'action': 'NoAction', 'reason': 'no signature triggered', 'message': message}
 
+class FlowBatch(object):
+    '''
+    Flow log records of one subscription batch, parsed into columns in one pass.
+    Addresses and interfaces are stored as integer codes into the addresses and
+    interfaces lists, so IPv4 and IPv6 compare the same way. The columns are
+    NumPy arrays when NumPy is available, lists otherwise.
+    '''
+    def __init__(self, messages):
+        self.addresses = []
+        self.interfaces = []
+        self.messages = []
+        addressCodes = {}
+        interfaceCodes = {}
+        interface, src, dst, srcPort, dstPort, accepted = [], [], [], [], [], []
+        for message in messages:
+            data = message.split()
+            # NODATA and SKIPDATA records have no addresses or ports
+            if len(data) != 14 or not data[5].isdigit() or not data[6].isdigit():
+                continue
+            for value, codes, values in ((data[2], interfaceCodes, self.interfaces),
+                                         (data[3], addressCodes, self.addresses),
+                                         (data[4], addressCodes, self.addresses)):
+                if value not in codes:
+                    codes[value] = len(values)
+                    values.append(value)
+            interface.append(interfaceCodes[data[2]])
+            src.append(addressCodes[data[3]])
+            dst.append(addressCodes[data[4]])
+            srcPort.append(int(data[5]))
+            dstPort.append(int(data[6]))
+            accepted.append(data[12] == 'ACCEPT')
+            self.messages.append(message)
+        self.addressCodes = addressCodes
+        columns = (interface, src, dst, srcPort, dstPort, accepted)
+        if numpy is not None:
+            columns = [numpy.array(column, dtype=numpy.bool_ if column is accepted else numpy.int64)
+                       for column in columns]
+        self.interface, self.src, self.dst, self.srcPort, self.dstPort, self.accepted = columns
+
+    def __len__(self):
+        return len(self.messages)
+
+    def instance_codes(self, instance_ips):
+        '''
+        Address code of the instance of each record, -1 when its IP is unknown
+        '''
+        lookup = [self.addressCodes.get(instance_ips.get(nic), -1) for nic in self.interfaces]
+        if numpy is not None:
+            return numpy.array(lookup, dtype=numpy.int64)[self.interface]
+        return [lookup[code] for code in self.interface]
+
+
+def flag_flows(batch, instance_ips):
+    '''
+    Applies the SSH outbound heuristic of eval_flow to a whole batch at once.
+    Returns the indices of the records that are SSH outbound from the instance.
+    The unrecognised-traffic check of eval_flow compares the dst_port string
+    with an integer, so it never triggered and isn't applied to batches.
+    '''
+    instance = batch.instance_codes(instance_ips)
+    if numpy is not None:
+        ssh = (batch.src == instance) & (batch.dstPort == 22) & (batch.srcPort != 22)
+        return numpy.flatnonzero(ssh).tolist()
+    return [n for n in range(len(batch))
+            if batch.src[n] == instance[n] and batch.dstPort[n] == 22 and batch.srcPort[n] != 22]
+
+
+def eval_batch(batch, instance_ips):
+    '''
+    Evaluates a FlowBatch, notifying once per instance and destination
+    '''
+    ssh = flag_flows(batch, instance_ips)
+    logging.info('Evaluated ' + str(len(batch)) + ' flow records: ' + str(len(ssh)) + ' SSH outbound')
+
+    ssh_hosts = set()
+    for n in ssh:
+        instance_ip = instance_ips[batch.interfaces[batch.interface[n]]]
+        dst_ip = batch.addresses[batch.dst[n]]
+        if (instance_ip, dst_ip) not in ssh_hosts:
+            ssh_hosts.add((instance_ip, dst_ip))
+            logging.info('SSH outbound detected...')
+            send_notification(subject="L2("+instance_ip+'): starting SSH outbound to '+dst_ip,message='Instance initiating SSH.')
+            if '10.0' in dst_ip:
+                send_notification(subject="L2("+instance_ip+'): SSH to internal host at '+dst_ip+'. Will isolate',message='Instance initiating SSH.')
+    return {'records': len(batch), 'ssh': len(ssh_hosts)}
+
 def get_ip_by_nic(nic):
     try:
         client = boto3.resource('ec2', region_name=global_args.REGION)
@@ -113,17 +204,15 @@ def lambda_handler(event, context):
     else:
         instance = ''
 
-    #Check each flow log
+    #Check the flow logs of the batch together
     if 'logEvents' in data:
-        instance_ip ='none'
-        instance_interface = 'none'
-        for event in data['logEvents']:
-            data = event['message'].split()
-            if data[2] != instance_interface:  #check for change in network interface
-                instance_ip = get_ip_by_nic(data[2])
-                instance_interface = data[2]
-                logging.info(data[2])
-            eval_flow(event['message'],instance_ip)
+        batch = FlowBatch([event['message'] for event in data['logEvents']])
+        #Look up each network interface once per batch
+        instance_ips = {}
+        for nic in batch.interfaces:
+            instance_ips[nic] = get_ip_by_nic(nic)
+            logging.info(nic)
+        eval_batch(batch, instance_ips)
     return "I'm done..."  # Echo back the first key value
     # raise Exception('Something went wrong')
 